@@ -2,15 +2,52 @@ import os
 import logging
 import json
 import asyncio
+import base64
+import collections
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import io
+import math
+import random
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    MessageHandler, filters, ContextTypes, ConversationHandler
+    MessageHandler, filters, ContextTypes, ConversationHandler,
+    TypeHandler, ApplicationHandlerStop, PicklePersistence, PersistenceInput
 )
+from telegram.request import HTTPXRequest
+
+# Распознавание бланков требует numpy и Pillow
+try:
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+except ImportError:
+    np = None
+    Image = ImageDraw = ImageFont = ImageOps = None
 
 # Получаем токен из переменных окружения
 BOT_TOKEN = os.environ.get('BOT_TOKEN', 'your_bot_token_here')
 
+# Момент запуска процесса - от него считается время готовности после перезапуска
+PROCESS_STARTED_AT = time.time()
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,16 +55,45 @@ logging.basicConfig(
 )
 
 # Состояния разговора
-MAIN_MENU, SELECTING_TEST, WAITING_ANSWERS, WAITING_ANSWERS_BUTTONS, ADMIN_PANEL = range(5)
+(MAIN_MENU, SELECTING_TEST, WAITING_ANSWERS, WAITING_ANSWERS_BUTTONS, ADMIN_PANEL,
+ BROADCAST_TEXT, BROADCAST_CONFIRM) = range(7)
 
 # Время теста в секундах (1 час + 5 минут = 65 минут)
 TEST_TIME_SECONDS = 65 * 60  # 3900 секунд
 
+# «Спринтер»: тест завершен быстрее половины отведенного времени
+SPEEDSTER_TIME_SECONDS = TEST_TIME_SECONDS // 2
+
 # Список администраторов (замените на ваши ID)
 ADMIN_IDS = [921454401]  # Ваш Telegram ID
 
-def is_admin(user_id):
-    return user_id in ADMIN_IDS
+# Рассылка: Telegram допускает ~30 сообщений в секунду, оставляем запас
+BROADCAST_MESSAGES_PER_SECOND = 25
+BROADCAST_BATCH_SIZE = 25
+BROADCAST_SEND_ATTEMPTS = 3
+
+# Статистика: в файле пользователя держим последние результаты и сводку,
+# старые результаты уходят пачками в сжатые сегменты data/stats/archive
+STATS_HOT_RESULTS = 20
+STATS_ARCHIVE_SEGMENT = 50
+
+def is_admin(user_id, context):
+    """Администраторы своего бота (школы) - без запасного общего списка"""
+    return user_id in context.bot_data['admin_ids']
+
+def pack_dwell(dwell):
+    """Упаковывает array('H') секунд по вопросам в base64 (little-endian)"""
+    if sys.byteorder != 'little':
+        dwell = array('H', dwell)
+        dwell.byteswap()
+    return base64.b64encode(dwell.tobytes()).decode('ascii')
+
+def unpack_dwell(packed):
+    dwell = array('H')
+    dwell.frombytes(base64.b64decode(packed))
+    if sys.byteorder != 'little':
+        dwell.byteswap()
+    return dwell
 
 print("=" * 50)
 print("🤖 Бот запускается на Render...")
@@ -71,7 +137,7 @@ class AchievementSystem:
         if not user_stats:
             return new_achievements
             
-        tests_count = len(user_stats.get('tests', []))
+        tests_count = user_stats['summary']['total_tests']
         
         # Проверяем достижения
         if tests_count == 1:
@@ -82,12 +148,23 @@ class AchievementSystem:
             
         if test_result['percentage'] == 100:
             new_achievements.append('perfectionist')
+        
+        if self.is_speedster(test_result):
+            new_achievements.append('speedster')
             
         if tests_count >= 5:
             new_achievements.append('persistent')
         
         return new_achievements
     
+    def is_speedster(self, test_result):
+        """Тест завершен быстрее половины отведенного времени"""
+        # Проверенный при закрытии экзамена тест ученик не сдавал сам
+        if test_result.get('auto_closed'):
+            return False
+        duration = test_result.get('timing', {}).get('duration')
+        return duration is not None and duration < SPEEDSTER_TIME_SECONDS
+    
     def get_achievement_message(self, achievement_ids):
         """Создает сообщение о полученных достижениях"""
         if not achievement_ids:
@@ -102,10 +179,14 @@ class AchievementSystem:
         return message
 
 class TestManager:
-    def __init__(self):
+    def __init__(self, data_dir='data', store=None):
         # Папки для хранения
-        self.tests_dir = 'data/tests'
-        self.stats_dir = 'data/stats'
+        self.tests_dir = os.path.join(data_dir, 'tests')
+        self.stats_dir = os.path.join(data_dir, 'stats')
+        self.pdf_dir = os.path.join(data_dir, 'pdfs')
+        self.store = store or StatsStore()
+        # Версия данных пользователя меняется с каждым сохранением (для кэша экранов)
+        self.versions = {}
         
         # Создаем папки если их нет
         os.makedirs(self.tests_dir, exist_ok=True)
@@ -116,6 +197,11 @@ class TestManager:
         
         # Загружаем тесты
         self.tests = self.load_tests()
+        
+        # Готовые клавиатуры вопросов, file_id загруженных PDF и бланков ответов
+        self.keyboards = {}
+        self.pdf_file_ids = {}
+        self.sheet_file_ids = {}
     
     def load_tests(self):
         """Загружает тесты (встроенные в код)"""
@@ -153,18 +239,121 @@ class TestManager:
                 'correct_answers': ['4', '15', '7', '25', '4']
             }
         }
+        
+        # Бумажные тесты: ключи ответов из data/tests, задания в data/pdfs
+        self.test_mtimes = {}
+        for filename in sorted(os.listdir(self.tests_dir)):
+            if filename.endswith('.json'):
+                test = self.load_test_file(filename)
+                if test:
+                    tests[filename[:-5]] = test
+        
         print(f"📁 Загружено тестов: {len(tests)}")
         return tests
     
+    def load_test_file(self, filename):
+        """Загружает тест из файла data/tests"""
+        test_id = filename[:-5]
+        path = os.path.join(self.tests_dir, filename)
+        try:
+            self.test_mtimes[test_id] = os.path.getmtime(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                test = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ Ошибка загрузки теста {filename}: {e}")
+            return None
+        pdf_filename = test.get('pdf_filename', f'{test_id}.pdf')
+        if os.path.exists(os.path.join(self.pdf_dir, pdf_filename)):
+            test['pdf_filename'] = pdf_filename
+        else:
+            test.pop('pdf_filename', None)
+        return test
+    
+    def reload_tests(self):
+        """Перечитывает измененные файлы тестов, возвращает (измененные, удаленные)"""
+        changed = []
+        present = set()
+        for filename in sorted(os.listdir(self.tests_dir)):
+            if not filename.endswith('.json'):
+                continue
+            test_id = filename[:-5]
+            present.add(test_id)
+            mtime = os.path.getmtime(os.path.join(self.tests_dir, filename))
+            if self.test_mtimes.get(test_id) == mtime:
+                continue
+            test = self.load_test_file(filename)
+            if test:
+                self.tests[test_id] = test
+                changed.append(test_id)
+        
+        removed = [test_id for test_id in self.test_mtimes if test_id not in present]
+        for test_id in removed:
+            self.tests.pop(test_id, None)
+            del self.test_mtimes[test_id]
+        
+        # Клавиатуры измененных тестов нужно построить заново
+        for test_id in changed + removed:
+            for key in [key for key in self.keyboards if key[0] == test_id]:
+                del self.keyboards[key]
+        return changed, removed
+    
     def get_test(self, test_id):
         return self.tests.get(test_id)
     
     def get_all_tests(self):
         return self.tests
     
-    def check_answers(self, test_id, user_answers, user_id):
+    def get_question_keyboard(self, test_id, question_index):
+        """Клавиатура вопроса из каталога (строится один раз)"""
+        key = (test_id, question_index)
+        keyboard = self.keyboards.get(key)
+        if keyboard is None:
+            keyboard = build_question_keyboard(self.tests[test_id]['questions'], question_index)
+            self.keyboards[key] = keyboard
+        return keyboard
+    
+    async def send_test_pdf(self, bot, chat_id, pdf_filename, caption=None):
+        """Отправляет PDF теста, повторно используя file_id уже загруженного файла"""
+        file_id = self.pdf_file_ids.get(pdf_filename)
+        if file_id:
+            return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+        with open(os.path.join(self.pdf_dir, pdf_filename), 'rb') as f:
+            message = await bot.send_document(chat_id=chat_id, document=f, caption=caption)
+        self.pdf_file_ids[pdf_filename] = message.document.file_id
+        return message
+    
+    async def send_answer_sheet(self, bot, chat_id, questions_count, caption=None):
+        """Отправляет пустой бланк ответов для печати (рисуется один раз на число вопросов)"""
+        if np is None:
+            return None
+        file_id = self.sheet_file_ids.get(questions_count)
+        if file_id:
+            return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+        buffer = io.BytesIO()
+        Image.fromarray(render_answer_sheet([None] * questions_count)).save(buffer, format='PNG')
+        buffer.seek(0)
+        message = await bot.send_document(
+            chat_id=chat_id, document=buffer, filename=f'blank_{questions_count}.png', caption=caption
+        )
+        self.sheet_file_ids[questions_count] = message.document.file_id
+        return message
+    
+    def check_answers(self, test_id, user_answers, user_id, test=None, timing=None):
         """Проверяет ответы пользователя"""
-        test = self.get_test(test_id)
+        test = test or self.get_test(test_id)
+        result = self.grade_answers(test_id, user_answers, test)
+        
+        # Сохраняем статистику (время ответов пишется вместе с результатом)
+        if 'error' not in result:
+            if timing:
+                result['timing'] = timing
+            self.save_statistics(user_id, test_id, result, test['name'])
+        
+        return result
+    
+    def grade_answers(self, test_id, user_answers, test=None):
+        """Проверяет ответы без сохранения статистики"""
+        test = test or self.get_test(test_id)
         if not test:
             return {'error': 'Тест не найден'}
             
@@ -204,86 +393,2047 @@ class TestManager:
             'detailed_results': detailed_results
         }
         
-        # Сохраняем статистику
-        self.save_statistics(user_id, test_id, result)
-        
         return result
     
-    def save_statistics(self, user_id, test_id, result):
+    def save_statistics(self, user_id, test_id, result, test_name=None):
         """Сохраняет статистику пользователя"""
-        user_file = os.path.join(self.stats_dir, f'{user_id}.json')
-        
-        user_data = {}
-        if os.path.exists(user_file):
-            with open(user_file, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-        
-        test_entry = {
-            'test_id': test_id,
-            'test_name': self.tests[test_id]['name'],
-            'result': result
-        }
-        
-        if 'tests' not in user_data:
-            user_data['tests'] = []
+        test_name = test_name or self.tests[test_id]['name']
+        self.save_statistics_bulk([(user_id, test_id, test_name, result)])
+    
+    def save_statistics_bulk(self, entries):
+        """Сохраняет несколько результатов (user_id, test_id, test_name, result):
+        файл каждого пользователя читается и пишется один раз"""
+        by_user = {}
+        for user_id, test_id, test_name, result in entries:
+            by_user.setdefault(user_id, []).append({
+                'test_id': test_id,
+                'test_name': test_name,
+                'result': result
+            })
         
-        user_data['tests'].append(test_entry)
+        for user_id, test_entries in by_user.items():
+            user_data = self.get_user_statistics(user_id) or {'tests': [], 'summary': self.summarize([])}
+            
+            user_data['tests'].extend(test_entries)
+            self.summarize(test_entries, user_data['summary'])
+            self.archive_cold_results(user_id, user_data)
+            
+            self.store.save(self.stats_dir, user_id, user_data)
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+    
+    def data_version(self, user_id):
+        return self.versions.get(user_id, 0)
+    
+    def summarize(self, tests, summary=None):
+        """Сводка по результатам: ее хватает экранам статистики и достижений"""
+        if summary is None:
+            summary = {'total_tests': 0, 'percentage_sum': 0, 'best_percentage': 0, 'speedster': False}
+        for test in tests:
+            percentage = test['result']['percentage']
+            summary['total_tests'] += 1
+            summary['percentage_sum'] += percentage
+            summary['best_percentage'] = max(summary['best_percentage'], percentage)
+            if self.achievement_system.is_speedster(test['result']):
+                summary['speedster'] = True
+        return summary
+    
+    def archive_cold_results(self, user_id, user_data):
+        """Переносит старые результаты в сжатый сегмент, когда их набралась пачка.
         
-        with open(user_file, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        Сегмент пишется раньше файла пользователя: если процесс упадет между
+        записями, результаты останутся в файле, а сегмент перезапишется позже.
+        """
+        tests = user_data['tests']
+        while len(tests) >= STATS_HOT_RESULTS + STATS_ARCHIVE_SEGMENT:
+            archive = user_data.setdefault('archive', [])
+            segment = self.store.save_segment(self.stats_dir, user_id, len(archive) + 1,
+                                              tests[:STATS_ARCHIVE_SEGMENT])
+            archive.append({'file': segment, 'count': STATS_ARCHIVE_SEGMENT})
+            del tests[:STATS_ARCHIVE_SEGMENT]
     
     def get_user_statistics(self, user_id):
-        """Получает статистику пользователя"""
-        user_file = os.path.join(self.stats_dir, f'{user_id}.json')
-        
-        if not os.path.exists(user_file):
-            return None
-        
-        with open(user_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        """Получает статистику пользователя: последние результаты и сводку"""
+        user_data = self.store.load(self.stats_dir, user_id)
+        if user_data is not None and 'summary' not in user_data:
+            # Файлы старого формата - вся история в 'tests', сводку считаем на лету
+            user_data.setdefault('tests', [])
+            user_data['summary'] = self.summarize(user_data['tests'])
+        return user_data
+    
+    def rebuild_summary(self, user_id):
+        """Пересчитывает сводку по всей истории (после восстановления из снимка)"""
+        user_data = self.get_user_statistics(user_id)
+        user_data['summary'] = self.summarize(self.get_full_history(user_id))
+        self.store.save(self.stats_dir, user_id, user_data)
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
+    
+    def get_full_history(self, user_id):
+        """Вся история пользователя: архивные сегменты распаковываются только здесь"""
+        user_data = self.get_user_statistics(user_id)
+        if not user_data:
+            return []
+        history = []
+        for segment in user_data.get('archive', []):
+            history.extend(self.store.load_segment(self.stats_dir, segment['file']))
+        history.extend(user_data['tests'])
+        return history
     
     def get_all_users_stats(self):
         """Получает статистику всех пользователей"""
         all_stats = []
-        if os.path.exists(self.stats_dir):
-            for filename in os.listdir(self.stats_dir):
-                if filename.endswith('.json'):
-                    user_id = filename[:-5]
+        for user_id in self.iter_user_ids():
+            try:
+                user_data = self.get_user_statistics(user_id)
+            except (OSError, ValueError):
+                continue
+            if user_data is not None:
+                all_stats.append({
+                    'user_id': str(user_id),
+                    'stats': user_data
+                })
+        return all_stats
+
+    def iter_user_ids(self):
+        """Перебирает ID пользователей без загрузки их статистики"""
+        return self.store.iter_user_ids(self.stats_dir)
+
+class StatsStore:
+    """Файловое хранилище статистики, общее для всех ботов процесса.
+    
+    У каждого бота своя папка (пространство имен), файлы пользователей
+    перезаписываются атомарно: во временный файл и затем os.replace.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def user_file(self, stats_dir, user_id):
+        return os.path.join(stats_dir, f'{user_id}.json')
+
+    def load(self, stats_dir, user_id):
+        user_file = self.user_file(stats_dir, user_id)
+        if not os.path.exists(user_file):
+            return None
+        self.reads += 1
+        with open(user_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, stats_dir, user_id, user_data):
+        user_file = self.user_file(stats_dir, user_id)
+        tmp_path = user_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, user_file)
+        self.writes += 1
+
+    def save_segment(self, stats_dir, user_id, seq, tests):
+        """Пишет сжатый архивный сегмент, возвращает путь относительно stats_dir"""
+        segment = os.path.join('archive', str(user_id), f'{seq:06d}.json.gz')
+        path = os.path.join(stats_dir, segment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(tests, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        self.writes += 1
+        return segment
+
+    def load_segment(self, stats_dir, segment):
+        self.reads += 1
+        with gzip.open(os.path.join(stats_dir, segment), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def iter_user_ids(self, stats_dir):
+        if not os.path.exists(stats_dir):
+            return
+        with os.scandir(stats_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.json'):
                     try:
-                        with open(os.path.join(self.stats_dir, filename), 'r', encoding='utf-8') as f:
-                            user_data = json.load(f)
-                            all_stats.append({
-                                'user_id': user_id,
-                                'stats': user_data
-                            })
-                    except:
+                        yield int(entry.name[:-5])
+                    except ValueError:
                         continue
-        return all_stats
 
-async def timer_task(context: ContextTypes.DEFAULT_TYPE, chat_id: int, test_name: str):
-    """Задача таймера - ждет и отправляет сообщение о завершении времени"""
+class BroadcastManager:
+    """Рассылка сообщений всем пользователям с сохранением прогресса"""
+
+    def __init__(self, test_manager, data_dir='data'):
+        self.test_manager = test_manager
+        self.broadcasts_dir = os.path.join(data_dir, 'broadcasts')
+        os.makedirs(self.broadcasts_dir, exist_ok=True)
+
+        # Текущая рассылка и список заблокировавших бота
+        self.state_file = os.path.join(self.broadcasts_dir, 'current.json')
+        self.blocked_file = os.path.join(self.broadcasts_dir, 'blocked.json')
+        self.blocked = set(self._load_json(self.blocked_file, []))
+
+        self.task = None
+
+    def _load_json(self, path, default):
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _write_json(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _sent_log(self, broadcast_id):
+        return os.path.join(self.broadcasts_dir, f'{broadcast_id}.sent')
+
+    def get_state(self):
+        return self._load_json(self.state_file, None)
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, bot, text, pdf_name=None):
+        """Создает новую рассылку и запускает ее в фоне"""
+        state = {
+            'id': uuid.uuid4().hex[:12],
+            'text': text,
+            'pdf': pdf_name,
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'done': False
+        }
+        self._write_json(self.state_file, state)
+        self.task = asyncio.create_task(self.run(bot, state))
+        return state
+
+    def resume(self, bot):
+        """Продолжает незавершенную рассылку после перезапуска"""
+        state = self.get_state()
+        if not state or state.get('done') or self.is_running():
+            return None
+        print(f"📢 Продолжаем рассылку {state['id']} (отправлено: {state['sent']})")
+        self.task = asyncio.create_task(self.run(bot, state))
+        return state
+
+    async def run(self, bot, state):
+        """Отправляет сообщения пачками, сохраняя прогресс после каждой"""
+        sent_log = self._sent_log(state['id'])
+        delivered = set()
+        if os.path.exists(sent_log):
+            with open(sent_log, 'r', encoding='utf-8') as f:
+                delivered = {int(line) for line in f if line.strip()}
+
+        try:
+            batch = []
+            deferred = []
+            for user_id in self.test_manager.iter_user_ids():
+                if user_id in delivered or user_id in self.blocked:
+                    continue
+                batch.append(user_id)
+                if len(batch) >= BROADCAST_BATCH_SIZE:
+                    deferred += await self._send_batch(bot, state, batch, sent_log)
+                    batch = []
+            if batch:
+                deferred += await self._send_batch(bot, state, batch, sent_log)
+            
+            # Сетевые сбои: еще один проход в конце, когда связь могла восстановиться
+            for i in range(0, len(deferred), BROADCAST_BATCH_SIZE):
+                await self._send_batch(bot, state, deferred[i:i + BROADCAST_BATCH_SIZE], sent_log, final=True)
+
+            state['done'] = True
+            self._write_json(self.state_file, state)
+            print(f"📢 Рассылка {state['id']} завершена: отправлено {state['sent']}, "
+                  f"заблокировали {state['blocked']}, ошибок {state['failed']}")
+        except asyncio.CancelledError:
+            print(f"📢 Рассылка {state['id']} прервана, прогресс сохранен")
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка рассылки: {e}")
+
+    async def _send_batch(self, bot, state, batch, sent_log, final=False):
+        """Отправляет пачку, возвращает пользователей, которым не удалось отправить из-за сети"""
+        started = time.monotonic()
+        messages = 0
+        processed = []
+        deferred = []
+        newly_blocked = False
+
+        for user_id in batch:
+            status, count = await self._send_one(bot, user_id, state)
+            messages += count
+            if status == 'sent':
+                state['sent'] += 1
+            elif status == 'blocked':
+                state['blocked'] += 1
+                self.blocked.add(user_id)
+                newly_blocked = True
+            elif status == 'network':
+                # В журнал не пишем: после перезапуска отправим еще раз
+                if final:
+                    state['failed'] += 1
+                deferred.append(user_id)
+                continue
+            else:
+                state['failed'] += 1
+            processed.append(user_id)
+
+        # Контрольная точка: после перезапуска эти пользователи будут пропущены
+        with open(sent_log, 'a', encoding='utf-8') as f:
+            f.write(''.join(f'{user_id}\n' for user_id in processed))
+        self._write_json(self.state_file, state)
+        if newly_blocked:
+            self._write_json(self.blocked_file, sorted(self.blocked))
+
+        # Держим скорость в пределах лимита Telegram
+        min_duration = messages / BROADCAST_MESSAGES_PER_SECOND
+        elapsed = time.monotonic() - started
+        if elapsed < min_duration:
+            await asyncio.sleep(min_duration - elapsed)
+        return deferred
+
+    async def _send_one(self, bot, user_id, state):
+        """Отправляет сообщение одному пользователю, возвращает (статус, число сообщений)"""
+        status = 'failed'
+        for attempt in range(BROADCAST_SEND_ATTEMPTS):
+            try:
+                return 'sent', await self._deliver(bot, user_id, state)
+            except RetryAfter as e:
+                # Если лимит не отпустил за все попытки, откладываем как при сбое сети
+                print(f"📢 Лимит Telegram, ждем {e.retry_after} сек")
+                status = 'network'
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                return 'blocked', 1
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'blocked', 1
+                print(f"❌ Рассылка пользователю {user_id}: {e}")
+                return 'failed', 1
+            except NetworkError as e:
+                # TimedOut и обрывы связи - временные, повторяем с паузой
+                print(f"📢 Сетевая ошибка для {user_id}: {e}, повтор")
+                status = 'network'
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                print(f"❌ Рассылка пользователю {user_id}: {e}")
+                return 'failed', 1
+        return status, 1
+
+    async def _deliver(self, bot, user_id, state):
+        """Отправляет текст и PDF; уже дошедший текст при повторе не отправляется"""
+        text = state['text']
+        pdf_name = state.get('pdf')
+        if not pdf_name:
+            await bot.send_message(chat_id=user_id, text=text)
+            return 1
+
+        messages = 0
+        caption = text
+        # Подпись к документу ограничена 1024 символами
+        if len(text) > 1024:
+            # Кому текст уже дошел, сохраняется вместе с состоянием рассылки
+            text_sent = state.setdefault('text_sent', [])
+            if user_id not in text_sent:
+                await bot.send_message(chat_id=user_id, text=text)
+                text_sent.append(user_id)
+                messages += 1
+            caption = None
+
+        await self.test_manager.send_test_pdf(bot, user_id, pdf_name, caption)
+        if user_id in state.get('text_sent', ()):
+            state['text_sent'].remove(user_id)
+        return messages + 1
+
+# Распознавание бланков ответов (OMR)
+OMR_OPTION_LETTERS = 'ABCDEF'
+OMR_ROWS_PER_BLOCK = 15      # вопросов в одной колонке бланка
+OMR_MARKER_SIZE = 0.03       # сторона угловой метки в долях от меньшей стороны листа
+OMR_FILL_THRESHOLD = 0.45    # доля темных пикселей в закрашенном кружке
+OMR_AMBIGUITY_RATIO = 0.75   # второй кружок закрашен почти так же - ответ неоднозначен
+OMR_MAX_SIDE = 1200          # перед распознаванием фото уменьшается до этого размера
+OMR_WORKERS = int(os.environ.get('OMR_WORKERS', min(2, os.cpu_count() or 1)))
+OMR_MAX_QUEUE = 20
+
+def _omr_layout(questions_count, options_count):
+    """Центры кружков в долях от расстояния между угловыми метками"""
+    blocks = -(-questions_count // OMR_ROWS_PER_BLOCK)
+    rows = min(questions_count, OMR_ROWS_PER_BLOCK)
+    question = np.arange(questions_count)
+    block = question // OMR_ROWS_PER_BLOCK
+    row = question % OMR_ROWS_PER_BLOCK
+    option = np.arange(options_count)
+    
+    # Первая ячейка каждого блока занята номером вопроса, сверху шапка бланка
+    u = (block[:, None] + (option[None, :] + 1.5) / (options_count + 1)) / blocks
+    v = np.broadcast_to(((row + 0.5) / rows)[:, None], u.shape)
+    u = 0.05 + 0.9 * u
+    v = 0.12 + 0.83 * v
+    cell = (0.9 / blocks / (options_count + 1), 0.83 / rows)
+    return u, v, cell
+
+def _omr_map(u, v, corners):
+    """Переводит доли в пиксели по четырем меткам (учитывает наклон и перспективу)"""
+    tl, tr, bl, br = corners
+    x = (1 - u) * (1 - v) * tl[0] + u * (1 - v) * tr[0] + (1 - u) * v * bl[0] + u * v * br[0]
+    y = (1 - u) * (1 - v) * tl[1] + u * (1 - v) * tr[1] + (1 - u) * v * bl[1] + u * v * br[1]
+    return x, y
+
+def _otsu_threshold(gray):
+    """Порог бинаризации по методу Оцу"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    cum_mean = np.cumsum(hist * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_bg = cum_mean / weight_bg
+        mean_fg = (cum_mean[-1] - cum_mean) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.nanargmax(between))
+
+def _find_markers(integral, height, width):
+    """Ищет четыре угловые метки: сплошные темные квадраты ближе всего к углам"""
+    size = max(3, int(min(height, width) * OMR_MARKER_SIZE * 0.4))
+    box = (integral[size:, size:] - integral[:-size, size:]
+           - integral[size:, :-size] + integral[:-size, :-size])
+    ys, xs = np.nonzero(box >= 0.95 * size * size)
+    if len(xs) == 0:
+        return None
+    
+    corners = []
+    for score in (xs + ys, (width - xs) + ys, xs + (height - ys), (width - xs) + (height - ys)):
+        seed = np.argmin(score)
+        near = (np.abs(xs - xs[seed]) <= 2 * size) & (np.abs(ys - ys[seed]) <= 2 * size)
+        corners.append((xs[near].mean() + size / 2, ys[near].mean() + size / 2))
+    corners = np.array(corners)
+    
+    # Метки должны образовывать четырехугольник, а не сливаться в одну точку
+    if np.hypot(*(corners[3] - corners[0])) < min(height, width) * 0.3:
+        return None
+    return corners
+
+def decode_answer_sheet(image_bytes, questions_count, options_count=4):
+    """Распознает отмеченные кружки на фото бланка.
+    
+    Выполняется в процессе-обработчике. Возвращает (ответы, время распознавания),
+    нераспознанные ответы равны None; если метки не найдены, ответы равны None.
+    """
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.exif_transpose(image).convert('L')
+        image.thumbnail((OMR_MAX_SIDE, OMR_MAX_SIDE))
+        gray = np.asarray(image, dtype=np.uint8)
+    
+    dark = gray <= _otsu_threshold(gray)
+    height, width = dark.shape
+    integral = np.zeros((height + 1, width + 1), dtype=np.int32)
+    integral[1:, 1:] = dark.cumsum(axis=0, dtype=np.int32).cumsum(axis=1)
+    
+    corners = _find_markers(integral, height, width)
+    if corners is None:
+        return None, time.perf_counter() - started
+    
+    u, v, cell = _omr_layout(questions_count, options_count)
+    xs, ys = _omr_map(u, v, corners)
+    span_x = np.hypot(*(corners[1] - corners[0]))
+    span_y = np.hypot(*(corners[2] - corners[0]))
+    half = max(1, int(0.15 * min(cell[0] * span_x, cell[1] * span_y)))
+    
+    # Доля темных пикселей в квадрате внутри каждого кружка
+    x0 = np.clip(np.rint(xs).astype(int) - half, 0, width)
+    x1 = np.clip(np.rint(xs).astype(int) + half + 1, 0, width)
+    y0 = np.clip(np.rint(ys).astype(int) - half, 0, height)
+    y1 = np.clip(np.rint(ys).astype(int) + half + 1, 0, height)
+    area = np.maximum((x1 - x0) * (y1 - y0), 1)
+    fill = (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]) / area
+    
+    order = np.argsort(fill, axis=1)
+    rows = np.arange(questions_count)
+    best = fill[rows, order[:, -1]]
+    second = fill[rows, order[:, -2]] if options_count > 1 else np.zeros(questions_count)
+    
+    answers = []
+    for i in range(questions_count):
+        if best[i] < OMR_FILL_THRESHOLD or second[i] >= OMR_AMBIGUITY_RATIO * best[i]:
+            answers.append(None)
+        else:
+            answers.append(OMR_OPTION_LETTERS[order[i, -1]])
+    return answers, time.perf_counter() - started
+
+def render_answer_sheet(answers, options_count=4, size=(1240, 1754)):
+    """Рисует бланк ответов; пустой бланк ([None] * n) отправляется ученикам для печати"""
+    width, height = size
+    sheet = np.full((height, width), 255, dtype=np.uint8)
+    margin = int(min(width, height) * 0.06)
+    marker = int(min(width, height) * OMR_MARKER_SIZE)
+    corners = np.array([
+        (margin, margin), (width - margin, margin),
+        (margin, height - margin), (width - margin, height - margin)
+    ], dtype=np.float64)
+    for x, y in corners.astype(int):
+        sheet[y - marker // 2:y + marker // 2, x - marker // 2:x + marker // 2] = 0
+    
+    u, v, cell = _omr_layout(len(answers), options_count)
+    xs, ys = _omr_map(u, v, corners)
+    radius = 0.3 * min(cell[0] * (width - 2 * margin), cell[1] * (height - 2 * margin))
+    pad = int(radius) + 3
+    for q, answer in enumerate(answers):
+        for o in range(options_count):
+            cx, cy = xs[q, o], ys[q, o]
+            x0, y0 = int(cx) - pad, int(cy) - pad
+            py, px = np.ogrid[y0:y0 + 2 * pad, x0:x0 + 2 * pad]
+            dist = np.hypot(px - cx, py - cy)
+            patch = sheet[y0:y0 + 2 * pad, x0:x0 + 2 * pad]
+            patch[(dist <= radius) & (dist >= radius - 2)] = 0
+            if answer == OMR_OPTION_LETTERS[o]:
+                patch[dist <= radius * 0.85] = 0
+    
+    # Номера вопросов в первой ячейке строки и буквы вариантов над каждым блоком
+    image = Image.fromarray(sheet)
+    draw = ImageDraw.Draw(image)
     try:
-        print(f"⏰ Таймер запущен для теста '{test_name}'")
-        await asyncio.sleep(TEST_TIME_SECONDS)
-        
-        # Проверяем, не отправлены ли уже ответы
-        if not context.user_data.get('test_completed', False):
-            print(f"⏰ Время вышло для теста '{test_name}'")
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"⏰ ВРЕМЯ ВЫШЛО!\n\n"
-                     f"Тест '{test_name}' завершен.\n"
-                     f"Вы не успели отправить ответы вовремя.\n\n"
-                     f"➡️ Используйте /start чтобы начать новый тест."
+        font = ImageFont.load_default(size=max(12, int(radius * 1.2)))
+    except (TypeError, OSError, ImportError):
+        font = ImageFont.load_default()
+    number_u = u[:, 0] - (u[:, 1] - u[:, 0])
+    number_x, number_y = _omr_map(number_u, v[:, 0], corners)
+    for q in range(len(answers)):
+        draw.text((number_x[q], number_y[q]), str(q + 1), fill=0, font=font, anchor='mm')
+    for q in range(0, len(answers), OMR_ROWS_PER_BLOCK):
+        for o in range(options_count):
+            draw.text((xs[q, o], ys[q, o] - 2.2 * radius), OMR_OPTION_LETTERS[o],
+                      fill=0, font=font, anchor='mm')
+    return np.asarray(image)
+
+class AnswerSheetRecognizer:
+    """Распознавание бланков в пуле процессов, чтобы не блокировать цикл событий"""
+
+    def __init__(self, workers=OMR_WORKERS, max_queue=OMR_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = None
+        
+        # Метрики: бланки в работе и в очереди, время распознавания и ожидания
+        self.pending = 0
+        self.processed = 0
+        self.failed = 0
+        self.decode_times = collections.deque(maxlen=100)
+        self.wait_times = collections.deque(maxlen=100)
+
+    def is_available(self):
+        return np is not None and Image is not None
+
+    def is_busy(self):
+        return self.pending >= self.max_queue
+
+    def queue_depth(self):
+        return max(0, self.pending - self.workers)
+
+    async def recognize(self, image_bytes, questions_count, options_count):
+        """Распознает бланк, возвращает список букв или None"""
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            answers, decode_time = await loop.run_in_executor(
+                self.executor, decode_answer_sheet, image_bytes, questions_count, options_count
             )
-            context.user_data['time_expired'] = True
-            context.user_data['test_completed'] = True
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        
+        self.processed += 1
+        self.decode_times.append(decode_time)
+        self.wait_times.append(time.perf_counter() - submitted - decode_time)
+        print(f"📷 Бланк распознан за {decode_time * 1000:.0f} мс "
+              f"(в очереди: {self.queue_depth()})")
+        return answers
+
+    def get_stats_text(self):
+        if not self.processed and not self.failed:
+            return "📷 Бланки: пока не было\n"
+        avg_decode = sum(self.decode_times) / len(self.decode_times) if self.decode_times else 0
+        avg_wait = sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0
+        return (f"📷 Бланков распознано: {self.processed} (ошибок: {self.failed})\n"
+                f"   Распознавание: {avg_decode * 1000:.0f} мс, ожидание: {avg_wait * 1000:.0f} мс\n"
+                f"   Сейчас в очереди: {self.queue_depth()}\n")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+def benchmark_omr(sheets=200, questions_count=30):
+    """Замер скорости распознавания: бланков в секунду на ядро"""
+    rng = random.Random(0)
+    images = []
+    for _ in range(8):
+        answers = [rng.choice('ABCD') for _ in range(questions_count)]
+        buffer = io.BytesIO()
+        Image.fromarray(render_answer_sheet(answers)).save(buffer, format='JPEG', quality=85)
+        images.append((buffer.getvalue(), answers))
+    
+    # Проверяем, что синтетические бланки распознаются правильно
+    for image_bytes, answers in images:
+        decoded, _ = decode_answer_sheet(image_bytes, questions_count)
+        assert decoded == answers, "бланк распознан неверно"
+    
+    started = time.perf_counter()
+    for i in range(sheets // 4):
+        decode_answer_sheet(images[i % len(images)][0], questions_count)
+    single = (sheets // 4) / (time.perf_counter() - started)
+    print(f"📷 1 процесс: {single:.1f} бланков/сек")
+    
+    with ProcessPoolExecutor(max_workers=OMR_WORKERS) as executor:
+        list(executor.map(decode_answer_sheet, [images[0][0]] * OMR_WORKERS, [questions_count] * OMR_WORKERS))
+        started = time.perf_counter()
+        list(executor.map(
+            decode_answer_sheet,
+            [images[i % len(images)][0] for i in range(sheets)],
+            [questions_count] * sheets
+        ))
+        elapsed = time.perf_counter() - started
+    print(f"📷 Пул из {OMR_WORKERS} процессов: {sheets / elapsed:.1f} бланков/сек, "
+          f"{sheets / elapsed / OMR_WORKERS:.1f} бланков/сек на ядро")
+
+# Экзамены по расписанию: подготовка заранее и общая проверка по окончании
+EXAM_PREWARM_SECONDS = 5 * 60
+EXAM_TIME_FORMAT = '%Y-%m-%dT%H:%M'
+
+class ExamScheduler:
+    """Окна экзаменов для класса: общий старт, подготовка и пакетная проверка"""
+
+    def __init__(self, test_manager, data_dir='data'):
+        self.test_manager = test_manager
+        self.exams_dir = os.path.join(data_dir, 'exams')
+        os.makedirs(self.exams_dir, exist_ok=True)
+        self.windows_file = os.path.join(self.exams_dir, 'windows.json')
+        
+        self.windows = {}
+        if os.path.exists(self.windows_file):
+            with open(self.windows_file, 'r', encoding='utf-8') as f:
+                self.windows = {window['id']: window for window in json.load(f)}
+        
+        # Сессии учеников, выделенные заранее: {id окна: {user_id: сессия}}
+        self.sessions = {}
+        self.tasks = {}
+
+    def _save(self):
+        tmp_path = self.windows_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self.windows.values()), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.windows_file)
+
+    def schedule(self, application, test_id, start_ts, end_ts, user_ids, admin_chat_id):
+        """Создает окно экзамена и ставит его в расписание"""
+        window = {
+            'id': uuid.uuid4().hex[:8],
+            'test_id': test_id,
+            'start': start_ts,
+            'end': end_ts,
+            'users': sorted(set(user_ids)),
+            'admin_chat_id': admin_chat_id,
+            'status': 'scheduled'
+        }
+        self._snapshot_test(window)
+        self.windows[window['id']] = window
+        self._save()
+        self.arm(application, window)
+        return window
+
+    def _snapshot_test(self, window):
+        """Запоминает в окне ключ ответов, чтобы /reload_tests не мешал проверке"""
+        test = self.test_manager.get_test(window['test_id'])
+        if test:
+            window['answer_key'] = {
+                'name': test['name'],
+                'questions_count': test['questions_count'],
+                'correct_answers': list(test.get('correct_answers', []))
+            }
+        return window.get('answer_key')
+
+    def cancel(self, window_id):
+        window = self.windows.pop(window_id, None)
+        if not window:
+            return False
+        task = self.tasks.pop(window_id, None)
+        if task and not task.done():
+            task.cancel()
+        self.sessions.pop(window_id, None)
+        self._save()
+        return True
+
+    def arm_all(self, application):
+        """Восстанавливает расписание после перезапуска"""
+        for window in self.windows.values():
+            if window['status'] != 'closed':
+                self.arm(application, window)
+
+    def arm(self, application, window):
+        self.tasks[window['id']] = asyncio.create_task(self._run_window(application, window))
+
+    def get_open_window(self, window_id, user_id):
+        """Возвращает открытое окно, если пользователь допущен к экзамену"""
+        window = self.windows.get(window_id)
+        if not window or window['status'] != 'open' or user_id not in window['users']:
+            return None
+        if time.time() >= window['end']:
+            return None
+        return window
+
+    def get_session(self, window_id, user_id):
+        return self.sessions.get(window_id, {}).get(user_id)
+
+    async def _run_window(self, application, window):
+        try:
+            # Окно могло закончиться, пока бот был остановлен: не приглашаем,
+            # а возвращаем начатые сессии и сразу закрываем
+            if time.time() >= window['end']:
+                self.restore_sessions(window, application.user_data)
+            else:
+                await asyncio.sleep(max(0, window['start'] - EXAM_PREWARM_SECONDS - time.time()))
+                await self.prewarm(application.bot, window, application.user_data)
+                
+                await asyncio.sleep(max(0, window['start'] - time.time()))
+                if window['status'] == 'scheduled' and time.time() < window['end']:
+                    await self.open(application.bot, window)
+                
+                await asyncio.sleep(max(0, window['end'] - time.time()))
+            await self.close(application, window)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка экзамена {window['id']}: {e}")
+
+    def restore_sessions(self, window, user_data=None):
+        """После перезапуска возвращает в окно сессии, восстановленные вместе с данными учеников"""
+        sessions = self.sessions.setdefault(window['id'], {})
+        for user_id in window['users']:
+            restored = (user_data or {}).get(user_id) or {}
+            if restored.get('attempt_id') == f"exam_{window['id']}" and 'exam_session' in restored:
+                sessions[user_id] = restored['exam_session']
+        return sessions
+
+    async def prewarm(self, bot, window, user_data=None):
+        """Заранее готовит все, что понадобится в момент старта"""
+        started = time.perf_counter()
+        sessions = self.restore_sessions(window, user_data)
+        test = self.test_manager.get_test(window['test_id'])
+        if not test:
+            print(f"❌ Экзамен {window['id']}: тест {window['test_id']} не найден")
+            return
+        self._snapshot_test(window)
+        self._save()
+        
+        # Клавиатуры всех вопросов
+        for question_index in range(len(test.get('questions', []))):
+            self.test_manager.get_question_keyboard(window['test_id'], question_index)
+        
+        # PDF загружается один раз, дальше рассылается по file_id
+        if test.get('pdf_filename') and test['pdf_filename'] not in self.test_manager.pdf_file_ids:
+            await self.test_manager.send_test_pdf(
+                bot, window['admin_chat_id'], test['pdf_filename'],
+                caption=f"📎 PDF для экзамена {window['id']} подготовлен"
+            )
+        if not test.get('questions') and test['questions_count'] not in self.test_manager.sheet_file_ids:
+            await self.test_manager.send_answer_sheet(
+                bot, window['admin_chat_id'], test['questions_count'],
+                caption=f"🖨 Бланк ответов для экзамена {window['id']} подготовлен"
+            )
+        
+        # Сессии всех допущенных учеников
+        questions_count = len(test.get('questions', []))
+        for user_id in window['users']:
+            sessions.setdefault(user_id, {
+                'user_answers': [None] * questions_count,
+                'started': False,
+                'completed': False
+            })
+        print(f"📅 Экзамен {window['id']} подготовлен за "
+              f"{(time.perf_counter() - started) * 1000:.0f} мс ({len(sessions)} сессий)")
+
+    async def open(self, bot, window):
+        """Открывает экзамен и приглашает учеников"""
+        window['status'] = 'open'
+        self._save()
+        
+        test = self.test_manager.get_test(window['test_id'])
+        end_text = datetime.fromtimestamp(window['end']).strftime('%H:%M')
+        keyboard = [[InlineKeyboardButton("🚀 Начать экзамен", callback_data=f"exam_{window['id']}")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        for user_id in window['users']:
+            started = time.monotonic()
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=f"📅 Экзамен «{test['name']}» начался!\n\n"
+                         f"⏰ Ответы принимаются до {end_text}.",
+                    reply_markup=reply_markup
+                )
+            except TelegramError as e:
+                print(f"❌ Экзамен {window['id']}: не удалось пригласить {user_id}: {e}")
+            # Держим скорость в пределах лимита Telegram
+            delay = 1 / BROADCAST_MESSAGES_PER_SECOND - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        print(f"📅 Экзамен {window['id']} открыт для {len(window['users'])} учеников")
+
+    async def close(self, application, window):
+        """Закрывает экзамен: проверяет все незавершенные сессии одним проходом"""
+        started = time.perf_counter()
+        test_id = window['test_id']
+        test = window.get('answer_key') or self._snapshot_test(window)
+        if not test:
+            # Окно остается незакрытым: после возвращения теста его закроет перезапуск
+            print(f"❌ Экзамен {window['id']}: тест {test_id} не найден, ответы не проверены")
+            try:
+                await application.bot.send_message(
+                    chat_id=window['admin_chat_id'],
+                    text=f"❌ Экзамен {window['id']}: тест {test_id} не найден, "
+                         f"ответы учеников не проверены.\n\n"
+                         f"Верните файл теста и перезапустите бота."
+                )
+            except TelegramError as e:
+                print(f"❌ Экзамен {window['id']}: не удалось отправить отчет: {e}")
+            return
+        
+        window['status'] = 'closed'
+        self._save()
+        
+        questions_count = test['questions_count']
+        sessions = self.sessions.pop(window['id'], {})
+        
+        entries = []
+        for user_id, session in sessions.items():
+            if not session['started'] or session['completed']:
+                continue
+            session['completed'] = True
+            answers = list(session['user_answers'])
+            answers += [None] * (questions_count - len(answers))
+            result = self.test_manager.grade_answers(test_id, answers[:questions_count], test=test)
+            result['auto_closed'] = True
+            entries.append((user_id, test_id, test['name'], result))
+            
+            # Ученик больше не может отвечать в этом тесте
+            user_data = application.user_data.get(user_id)
+            if user_data is not None and user_data.get('exam_session') is session:
+                timing = build_timing(user_data)
+                if timing:
+                    result['timing'] = timing
+                user_data['test_completed'] = True
+                user_data['time_expired'] = True
+        
+        # Все результаты записываются одной пачкой
+        self.test_manager.save_statistics_bulk(entries)
+        elapsed = time.perf_counter() - started
+        
+        finished = sum(1 for session in sessions.values() if session['started'])
+        no_shows = len(window['users']) - finished
+        print(f"📅 Экзамен {window['id']} закрыт: проверено автоматически {len(entries)} "
+              f"за {elapsed * 1000:.0f} мс")
+        
+        for user_id, _, _, result in entries:
+            try:
+                await application.bot.send_message(
+                    chat_id=user_id,
+                    text=f"⏰ Экзамен завершен!\n\n"
+                         f"✅ Правильных: {result['correct_count']}/{result['total_questions']}\n"
+                         f"📈 Процент: {result['percentage']}%"
+                )
+            except TelegramError as e:
+                print(f"❌ Экзамен {window['id']}: не удалось отправить результат {user_id}: {e}")
+            await asyncio.sleep(1 / BROADCAST_MESSAGES_PER_SECOND)
+        
+        try:
+            await application.bot.send_message(
+                chat_id=window['admin_chat_id'],
+                text=f"📅 Экзамен {window['id']} завершен\n\n"
+                     f"👥 Участников: {finished}\n"
+                     f"⏰ Проверено по окончании времени: {len(entries)}\n"
+                     f"🚫 Не пришли: {no_shows}"
+            )
+        except TelegramError as e:
+            print(f"❌ Экзамен {window['id']}: не удалось отправить отчет: {e}")
+
+# Банк вопросов для персональных тестов
+BANK_DIR = 'data/bank'
+ADAPTIVE_TEST_ID = 'adaptive'
+ADAPTIVE_TEST_NAME = 'Персональный тест 🎲'
+ADAPTIVE_TEST_QUESTIONS = 20
+DIFFICULTY_LEVELS = (1, 2, 3)
+
+class QuestionView:
+    """Вопросы сгенерированного теста: хранятся только индексы в банке"""
+
+    def __init__(self, bank, indices):
+        self.bank = bank
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        return self.bank.get_question(self.indices[position])
+
+    def __iter__(self):
+        return (self.bank.get_question(index) for index in self.indices)
+
+class QuestionBank:
+    """Большой банк вопросов с индексами по теме и сложности"""
+
+    def __init__(self, bank_dir=BANK_DIR):
+        self.bank_dir = bank_dir
+        self.seen_dir = os.path.join(bank_dir, 'seen')
+        os.makedirs(self.seen_dir, exist_ok=True)
+        
+        # Вопросы хранятся в параллельных списках, а не в словарях
+        self.texts = []
+        self.options = []
+        self.answers = []
+        self.topics = []
+        self.difficulties = []
+        self.topic_names = []
+        self.topic_ids = {}
+        
+        # Индексы: (тема, сложность) -> номера вопросов
+        self.strata = {}
+        
+        # Вопросы, которые пользователь уже видел
+        self.seen = {}
+        
+        self.load()
+
+    def load(self):
+        """Загружает вопросы из data/bank/*.json"""
+        for filename in sorted(os.listdir(self.bank_dir)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.bank_dir, filename), 'r', encoding='utf-8') as f:
+                    questions = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"❌ Ошибка загрузки банка {filename}: {e}")
+                continue
+            for question in questions:
+                self.add_question(
+                    question['question'], question['options'], question['correct_answer'],
+                    question.get('topic', 'Общее'), question.get('difficulty', 2)
+                )
+        if self.texts:
+            print(f"🎲 Банк вопросов: {len(self.texts)} вопросов, {len(self.topic_names)} тем")
+
+    def add_question(self, text, options, correct_answer, topic, difficulty):
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = len(self.topic_names)
+            self.topic_ids[topic] = topic_id
+            self.topic_names.append(topic)
+        
+        index = len(self.texts)
+        self.texts.append(text)
+        self.options.append(tuple(options))
+        self.answers.append(correct_answer)
+        self.topics.append(topic_id)
+        self.difficulties.append(difficulty)
+        self.strata.setdefault((topic_id, difficulty), []).append(index)
+        return index
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get_question(self, index):
+        return {
+            'question': self.texts[index],
+            'options': list(self.options[index]),
+            'correct_answer': self.answers[index]
+        }
+
+    def view(self, indices):
+        return QuestionView(self, indices)
+
+    def build_test(self, generated):
+        """Описание сгенерированного теста для проверки ответов"""
+        indices = generated['indices']
+        return {
+            'name': ADAPTIVE_TEST_NAME,
+            'questions_count': len(indices),
+            'correct_answers': [self.answers[index] for index in indices]
+        }
+
+    def _seen_file(self, user_id):
+        return os.path.join(self.seen_dir, f'{user_id}.bin')
+
+    def get_seen(self, user_id):
+        """Множество показанных пользователю вопросов (загружается один раз)"""
+        seen = self.seen.get(user_id)
+        if seen is None:
+            seen = set()
+            seen_file = self._seen_file(user_id)
+            if os.path.exists(seen_file):
+                indices = array('I')
+                with open(seen_file, 'rb') as f:
+                    indices.frombytes(f.read())
+                seen.update(indices)
+            self.seen[user_id] = seen
+        return seen
+
+    def _mark_seen(self, user_id, indices):
+        self.get_seen(user_id).update(indices)
+        with open(self._seen_file(user_id), 'ab') as f:
+            f.write(array('I', indices).tobytes())
+
+    def difficulty_mix(self, level):
+        """Доли легких, средних и сложных вопросов по прошлым результатам"""
+        if level is None:
+            return (0.3, 0.4, 0.3)
+        if level < 50:
+            return (0.5, 0.35, 0.15)
+        if level < 80:
+            return (0.25, 0.5, 0.25)
+        return (0.1, 0.4, 0.5)
+
+    def generate(self, user_id, count=ADAPTIVE_TEST_QUESTIONS, level=None, seed=None):
+        """Генерирует персональный тест: {'seed': ..., 'indices': [...]}.
+        
+        Вопросы равномерно распределяются по темам, сложность зависит от уровня
+        ученика. Каждый вопрос выбирается за O(1) из списка своей группы,
+        уже показанные вопросы по возможности не повторяются.
+        """
+        if seed is None:
+            seed = random.getrandbits(32)
+        rng = random.Random(seed)
+        count = min(count, len(self.texts))
+        seen = self.get_seen(user_id)
+        
+        # План теста: сложность каждого вопроса по долям, темы по кругу
+        mix = self.difficulty_mix(level)
+        plan = []
+        for difficulty, share in zip(DIFFICULTY_LEVELS, mix):
+            plan += [difficulty] * round(share * count)
+        plan = (plan + [2] * count)[:count]
+        rng.shuffle(plan)
+        
+        topic_order = list(range(len(self.topic_names)))
+        rng.shuffle(topic_order)
+        
+        chosen = []
+        chosen_set = set()
+        for position, difficulty in enumerate(plan):
+            topic_id = topic_order[position % len(topic_order)]
+            index = self._pick(rng, topic_id, difficulty, seen, chosen_set)
+            if index is None:
+                index = self._pick_any(rng, seen, chosen_set)
+            chosen.append(index)
+            chosen_set.add(index)
+        
+        self._mark_seen(user_id, chosen)
+        return {'seed': seed, 'indices': chosen}
+
+    def _pick(self, rng, topic_id, difficulty, seen, chosen, attempts=8):
+        # Сначала нужная сложность, потом соседние
+        for level in sorted(DIFFICULTY_LEVELS, key=lambda d: abs(d - difficulty)):
+            stratum = self.strata.get((topic_id, level))
+            if not stratum:
+                continue
+            for _ in range(attempts):
+                index = stratum[rng.randrange(len(stratum))]
+                if index not in seen and index not in chosen:
+                    return index
+        return None
+
+    def _pick_any(self, rng, seen, chosen):
+        # Все подходящие вопросы уже видены: берем любой, не повторяясь в тесте
+        for _ in range(64):
+            index = rng.randrange(len(self.texts))
+            if index not in seen and index not in chosen:
+                return index
+        for _ in range(64):
+            index = rng.randrange(len(self.texts))
+            if index not in chosen:
+                return index
+        return next(index for index in range(len(self.texts)) if index not in chosen)
+
+def benchmark_question_bank(size=100_000, tests=2000):
+    """Замер скорости генерации тестов на большом банке"""
+    bank = QuestionBank(tempfile.mkdtemp())
+    rng = random.Random(0)
+    topics = [f'Тема {i}' for i in range(40)]
+    for i in range(size):
+        bank.add_question(f'Вопрос {i}', ['1', '2', '3', '4'], '1',
+                          rng.choice(topics), rng.choice(DIFFICULTY_LEVELS))
+    
+    timings = []
+    for i in range(tests):
+        started = time.perf_counter()
+        bank.generate(i % 200, ADAPTIVE_TEST_QUESTIONS, level=rng.choice([None, 40, 70, 95]))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print(f"🎲 Банк из {size} вопросов: генерация теста в среднем "
+          f"{sum(timings) / len(timings) * 1000:.3f} мс, p99 {timings[int(len(timings) * 0.99)] * 1000:.3f} мс")
+    shutil.rmtree(bank.bank_dir, ignore_errors=True)
+
+# Поиск по тексту вопросов
+SEARCH_TOKEN_RE = re.compile(r'[a-zа-я]+|\d+(?:[.,]\d+)?|[√×÷±≤≥≠≈π∞²³^+\-=*/:<>%]')
+SEARCH_SYMBOL_ALIASES = {'*': '×', '·': '×', '/': '÷', ':': '÷'}
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+# Стемминг русских слов по алгоритму Snowball (Porter) для русского языка
+RUSSIAN_VOWELS = 'аеиоуыэюя'
+RU_PERFECTIVE_GERUND = ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись')
+RU_PERFECTIVE_GERUND_AFTER_A = ('в', 'вши', 'вшись')
+RU_ADJECTIVE = ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым',
+                'ом', 'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею')
+RU_PARTICIPLE = ('ивш', 'ывш', 'ующ')
+RU_PARTICIPLE_AFTER_A = ('ем', 'нн', 'вш', 'ющ', 'щ')
+RU_REFLEXIVE = ('ся', 'сь')
+RU_VERB = ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им',
+           'ым', 'ен', 'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть',
+           'ишь', 'ую', 'ю')
+RU_VERB_AFTER_A = ('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют',
+                   'ны', 'ть', 'ешь', 'нно')
+RU_NOUN = ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей',
+           'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях',
+           'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я')
+RU_SUPERLATIVE = ('ейше', 'ейш')
+RU_DERIVATIONAL = ('ость', 'ост')
+# Беглая гласная перед последней согласной основы: корень/корня, отрезок/отрезка, чисел/числа
+RU_FLEETING_BEFORE = 'кнцлр'
+# Формы, которые обязаны давать одну основу (проверяются в --bench-search)
+STEMMER_CHECKS = [
+    ('корень', 'корня', 'корнем', 'корню', 'корни', 'корней'),
+    ('площадь', 'площади', 'площадью', 'площадей'),
+    ('отрезок', 'отрезка', 'отрезком', 'отрезки', 'отрезков'),
+    ('число', 'числа', 'чисел', 'числами'),
+    ('уравнение', 'уравнения', 'уравнением', 'уравнений'),
+    ('треугольник', 'треугольника', 'треугольники', 'треугольников'),
+    ('степень', 'степени', 'степенью', 'степеней'),
+    ('конец', 'конца', 'концом'),
+    ('решить', 'решите', 'решили'),
+    ('квадратный', 'квадратного', 'квадратному', 'квадратными'),
+]
+
+def _ru_region(word, start):
+    """Начало области после первой согласной, идущей за гласной (R1/R2 в Snowball)"""
+    for i in range(start + 1, len(word)):
+        if word[i] not in RUSSIAN_VOWELS and word[i - 1] in RUSSIAN_VOWELS:
+            return i + 1
+    return len(word)
+
+def _ru_strip(word, start, endings, endings_after_a=()):
+    """Снимает самое длинное окончание не левее start, None - если снять нечего.
+    Окончания из endings_after_a снимаются только после «а» или «я»"""
+    best = ''
+    for ending in endings + endings_after_a:
+        if len(ending) > len(best) and word.endswith(ending) and len(word) - len(ending) >= start:
+            best = ending
+    if not best:
+        return None
+    cut = len(word) - len(best)
+    if best in endings_after_a and best not in endings:
+        if cut - 1 < start or word[cut - 1] not in 'ая':
+            return None
+    return word[:cut]
+
+# Словарь задач невелик: основа каждого слова считается один раз
+@functools.lru_cache(maxsize=65536)
+def stem_russian(word):
+    """Основа русского слова: Snowball и выпадение беглой гласной"""
+    rv = next((i + 1 for i, ch in enumerate(word) if ch in RUSSIAN_VOWELS), len(word))
+    r2 = _ru_region(word, _ru_region(word, 0))
+    
+    # Шаг 1: деепричастие, иначе возвратная частица и прилагательное/глагол/существительное
+    stripped = _ru_strip(word, rv, RU_PERFECTIVE_GERUND, RU_PERFECTIVE_GERUND_AFTER_A)
+    if stripped is None:
+        word = _ru_strip(word, rv, RU_REFLEXIVE) or word
+        stripped = _ru_strip(word, rv, RU_ADJECTIVE)
+        if stripped is not None:
+            stripped = _ru_strip(stripped, rv, RU_PARTICIPLE, RU_PARTICIPLE_AFTER_A) or stripped
         else:
-            print(f"⏰ Таймер отменен - тест '{test_name}' уже завершен")
-    except asyncio.CancelledError:
-        print("⏰ Таймер отменен")
-    except Exception as e:
-        print(f"❌ Ошибка в таймере: {e}")
+            stripped = (_ru_strip(word, rv, RU_VERB, RU_VERB_AFTER_A)
+                        or _ru_strip(word, rv, RU_NOUN))
+    word = stripped or word
+    
+    # Шаг 2: «и» на конце
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    
+    # Шаг 3: словообразовательный суффикс «ость» в R2
+    word = _ru_strip(word, r2, RU_DERIVATIONAL) or word
+    
+    # Шаг 4: «нн», превосходная степень, мягкий знак
+    if word.endswith('нн') and len(word) - 1 >= rv:
+        word = word[:-1]
+    else:
+        superlative = _ru_strip(word, rv, RU_SUPERLATIVE)
+        if superlative is not None:
+            word = superlative[:-1] if superlative.endswith('нн') else superlative
+        elif word.endswith('ь') and len(word) - 1 >= rv:
+            word = word[:-1]
+    
+    # Беглая гласная: «корен» и «корн», «отрезок» и «отрезк» сводятся к одной основе
+    if (len(word) >= 4 and word[-1] in RU_FLEETING_BEFORE and word[-2] in 'ео'
+            and word[-3] not in RUSSIAN_VOWELS):
+        word = word[:-2] + word[-1]
+    return word
+
+def check_stemmer():
+    """Проверяет, что формы из STEMMER_CHECKS сводятся к одной основе"""
+    for forms in STEMMER_CHECKS:
+        stems = {stem_russian(form) for form in forms}
+        assert len(stems) == 1, f"разные основы для {forms}: {sorted(stems)}"
+
+def tokenize(text):
+    """Разбивает текст на основы слов, числа и математические символы"""
+    tokens = []
+    for token in SEARCH_TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+        if token[0].isalpha():
+            tokens.append(stem_russian(token))
+        else:
+            tokens.append(SEARCH_SYMBOL_ALIASES.get(token, token.replace(',', '.')))
+    return tokens
+
+class QuestionSearchIndex:
+    """Инвертированный индекс по тексту вопросов и вариантам ответов"""
+
+    def __init__(self):
+        # Термин -> {номер документа: частота}
+        self.postings = {}
+        # Документ: (источник, номер вопроса), его термины и длина
+        self.docs = []
+        self.doc_terms = []
+        self.doc_lengths = []
+        self.source_docs = {}
+        self.total_length = 0
+        self.docs_count = 0
+
+    def add(self, source, position, text, options=()):
+        doc_id = len(self.docs)
+        tokens = tokenize(' '.join([text, *options]))
+        counts = collections.Counter(tokens)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        
+        self.docs.append((source, position))
+        self.doc_terms.append(tuple(counts))
+        self.doc_lengths.append(len(tokens))
+        self.source_docs.setdefault(source, []).append(doc_id)
+        self.total_length += len(tokens)
+        self.docs_count += 1
+        return doc_id
+
+    def remove_source(self, source):
+        """Удаляет из индекса все вопросы источника"""
+        for doc_id in self.source_docs.pop(source, []):
+            for term in self.doc_terms[doc_id]:
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self.postings[term]
+            self.total_length -= self.doc_lengths[doc_id]
+            self.docs_count -= 1
+            self.docs[doc_id] = None
+            self.doc_terms[doc_id] = ()
+            self.doc_lengths[doc_id] = 0
+
+    def index_test(self, test_id, test):
+        """Индексирует (или переиндексирует) вопросы теста"""
+        source = ('test', test_id)
+        self.remove_source(source)
+        for position, question in enumerate(test.get('questions', []) if test else []):
+            self.add(source, position, question['question'], question['options'])
+
+    def index_bank(self, question_bank):
+        source = ('bank', None)
+        self.remove_source(source)
+        for position in range(len(question_bank)):
+            self.add(source, position, question_bank.texts[position], question_bank.options[position])
+
+    def search(self, query, limit=10):
+        """Возвращает [(оценка, (источник, номер вопроса))] по убыванию оценки (BM25)"""
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self.postings]
+        if not terms or not self.docs_count:
+            return []
+        
+        # Сначала ищем документы со всеми терминами, начиная с самого редкого
+        terms.sort(key=lambda term: len(self.postings[term]))
+        candidates = set(self.postings[terms[0]])
+        for term in terms[1:]:
+            candidates.intersection_update(self.postings[term])
+            if not candidates:
+                break
+        if not candidates:
+            candidates = set().union(*(self.postings[term] for term in terms[:3]))
+        
+        avg_length = self.total_length / self.docs_count
+        weights = []
+        for term in terms:
+            df = len(self.postings[term])
+            idf = math.log(1 + (self.docs_count - df + 0.5) / (df + 0.5))
+            weights.append((self.postings[term], idf))
+        
+        def score(doc_id):
+            norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * self.doc_lengths[doc_id] / avg_length)
+            total = 0.0
+            for postings, idf in weights:
+                tf = postings.get(doc_id)
+                if tf:
+                    total += idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+            return total
+        
+        best = heapq.nlargest(limit, candidates, key=score)
+        return [(score(doc_id), self.docs[doc_id]) for doc_id in best]
+
+def benchmark_search(size=100_000, queries=500):
+    """Замер скорости поиска на большом банке вопросов"""
+    check_stemmer()
+    print(f"🔎 Стемминг: {len(STEMMER_CHECKS)} групп словоформ сводятся к одной основе")
+    rng = random.Random(0)
+    words = ['площадь', 'квадрата', 'треугольника', 'корень', 'уравнения', 'числа',
+             'периметр', 'прямоугольника', 'скорость', 'поезда', 'дроби', 'степени']
+    index = QuestionSearchIndex()
+    started = time.perf_counter()
+    for i in range(size):
+        text = ' '.join(rng.choice(words) for _ in range(6)) + f' {rng.randint(1, 99)} × √{rng.randint(1, 99)}'
+        index.add(('bank', None), i, text, [str(rng.randint(1, 99)) for _ in range(4)])
+    print(f"🔎 Индекс из {size} вопросов построен за {time.perf_counter() - started:.1f} сек")
+    
+    timings = []
+    for _ in range(queries):
+        query = f"{rng.choice(words)} {rng.choice(words)} √{rng.randint(1, 99)}"
+        started = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print(f"🔎 Поиск: в среднем {sum(timings) / len(timings) * 1000:.2f} мс, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} мс")
+
+# Защита от повторов: Telegram может доставить обновление еще раз
+DEDUP_MAX_ENTRIES = 20000
+DEDUP_TTL_SECONDS = 24 * 60 * 60
+DEDUP_SAVE_SECONDS = 60
+
+class UpdateDeduplicator:
+    """Ограниченный LRU-кэш обработанных ключей с TTL, сохраняемый между перезапусками"""
+
+    def __init__(self, data_dir='data', max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL_SECONDS):
+        state_dir = os.path.join(data_dir, 'state')
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_file = os.path.join(state_dir, 'dedup.json')
+        # Завершенные попытки дописываются сюда по одной строке до следующего сохранения кэша
+        self.log_file = os.path.join(state_dir, 'dedup.log')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        
+        # Ключ -> время обработки, от старых к новым
+        self.entries = collections.OrderedDict()
+        # Завершения попыток, результат которых еще не сохранен: на диск не пишутся
+        self.pending = set()
+        self.suppressed = 0
+        self.saved_at = time.monotonic()
+        
+        now = time.time()
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    for key, seen_at in json.load(f):
+                        if now - seen_at < self.ttl:
+                            self.entries[key] = seen_at
+            except (OSError, ValueError) as e:
+                print(f"❌ Не удалось загрузить кэш повторов: {e}")
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, seen_at = json.loads(line)
+                    except ValueError:
+                        # Строка, недописанная при аварийной остановке
+                        continue
+                    if now - seen_at < self.ttl:
+                        self.entries[key] = seen_at
+
+    def claim(self, *keys, pending=False):
+        """Запоминает ключи. Возвращает False, если хотя бы один уже обрабатывался.
+        
+        Ключи с pending=True остаются только в памяти до confirm() или release().
+        """
+        now = time.time()
+        duplicate = False
+        for key in keys:
+            seen_at = self.entries.get(key)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self.entries.move_to_end(key)
+                duplicate = True
+            else:
+                self.entries[key] = now
+                self.entries.move_to_end(key)
+        
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        
+        if duplicate:
+            self.suppressed += 1
+            return False
+        
+        if pending:
+            self.pending.update(keys)
+        elif time.monotonic() - self.saved_at >= DEDUP_SAVE_SECONDS:
+            self.save()
+        return True
+
+    def confirm(self, *keys):
+        """Записывает отложенные ключи на диск"""
+        self.pending.difference_update(keys)
+        now = time.time()
+        # Одна строка в журнал вместо перезаписи всего кэша
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            f.write(''.join(
+                json.dumps([key, self.entries.get(key, now)], ensure_ascii=False) + '\n' for key in keys
+            ))
+
+    def release(self, *keys):
+        """Забывает отложенные ключи: их можно будет обработать еще раз"""
+        for key in keys:
+            self.pending.discard(key)
+            self.entries.pop(key, None)
+
+    def save(self):
+        now = time.time()
+        entries = [[key, seen_at] for key, seen_at in self.entries.items()
+                   if now - seen_at < self.ttl and key not in self.pending]
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.state_file)
+        # Все записи журнала уже вошли в сохраненный кэш
+        open(self.log_file, 'w').close()
+        self.saved_at = time.monotonic()
+
+RENDER_CACHE_MAX_BYTES = 2 * 1024 * 1024
+RENDER_CACHE_ENTRY_OVERHEAD = 512  # кортеж ключа, клавиатура и служебные поля
+
+class RenderCache:
+    """LRU-кэш готовых экранов (текст + клавиатура) с ограничением по памяти.
+    
+    Ключ содержит версию данных пользователя, поэтому после нового результата
+    старые экраны просто перестают запрашиваться и вытесняются.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key, text, reply_markup):
+        size = len(text.encode('utf-8')) + RENDER_CACHE_ENTRY_OVERHEAD
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[2]
+        self.entries[key] = (text, reply_markup, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def get_stats_text(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests * 100 if requests else 0
+        return (f"🗂 Кэш экранов: {hit_rate:.0f}% попаданий ({self.hits} из {requests}), "
+                f"{len(self.entries)} экранов, {self.size // 1024} КБ\n")
+
+BACKUP_BYTES_PER_SECOND = 4 * 1024 * 1024  # ограничение фонового копирования
+
+class BackupManager:
+    """Инкрементальные снимки статистики без остановки бота.
+    
+    Файлы статистики перезаписываются через os.replace, поэтому жесткая ссылка
+    фиксирует содержимое файла. Ссылки на все измененные с прошлого снимка файлы
+    создаются за один шаг цикла событий, пока ни один обработчик не пишет, -
+    это и есть согласованный снимок. Сжатие и контрольные суммы считаются
+    потом в фоновом потоке с ограничением скорости.
+    """
+
+    def __init__(self, test_manager, data_dir='data', bytes_per_second=BACKUP_BYTES_PER_SECOND):
+        self.test_manager = test_manager
+        self.stats_dir = test_manager.stats_dir
+        self.backups_dir = os.path.join(data_dir, 'backups')
+        os.makedirs(self.backups_dir, exist_ok=True)
+        self.latest_file = os.path.join(self.backups_dir, 'latest.json')
+        self.bytes_per_second = bytes_per_second
+        self.task = None
+
+    def _write_json(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _backup_name(self, rel):
+        # Архивные сегменты уже сжаты - копируем как есть
+        return rel if rel.endswith('.gz') else rel + '.gz'
+
+    def load_manifest(self, snapshot_id=None):
+        """Манифест снимка (по умолчанию последнего) или None"""
+        if snapshot_id is None:
+            if not os.path.exists(self.latest_file):
+                return None
+            with open(self.latest_file, 'r', encoding='utf-8') as f:
+                snapshot_id = json.load(f)['id']
+        with open(os.path.join(self.backups_dir, snapshot_id, 'manifest.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, bot=None, chat_id=None):
+        """Фиксирует снимок и запускает его сохранение в фоне"""
+        previous = self.load_manifest()
+        snapshot_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:4]
+        
+        started = time.monotonic()
+        files, changed = self._stage(snapshot_id, previous)
+        report = {
+            'id': snapshot_id,
+            'files': len(files),
+            'changed': len(changed),
+            'pause_ms': (time.monotonic() - started) * 1000
+        }
+        self.task = asyncio.create_task(self.run(bot, chat_id, report, previous, files, changed))
+        return report
+
+    def _stage(self, snapshot_id, previous):
+        """Жесткие ссылки на измененные файлы. Выполняется без await между файлами"""
+        staging = os.path.join(self.backups_dir, snapshot_id, 'staging')
+        previous_files = previous['files'] if previous else {}
+        files = {}
+        changed = []
+        for root, dirs, names in os.walk(self.stats_dir):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.stats_dir)
+                st = os.stat(path)
+                # Замена файла через os.replace меняет inode
+                stamp = [st.st_ino, st.st_size, st.st_mtime_ns]
+                old = previous_files.get(rel)
+                if old and old['stamp'] == stamp:
+                    files[rel] = old
+                    continue
+                target = os.path.join(staging, rel)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy2(path, target)
+                files[rel] = {'stamp': stamp, 'snapshot': snapshot_id}
+                changed.append(rel)
+        return files, changed
+
+    async def run(self, bot, chat_id, report, previous, files, changed):
+        snapshot_dir = os.path.join(self.backups_dir, report['id'])
+        started = time.monotonic()
+        try:
+            report['bytes'] = await asyncio.to_thread(self._store, report['id'], previous, files, changed)
+        except Exception as e:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            print(f"❌ Ошибка резервного копирования: {e}")
+            if bot and chat_id:
+                await bot.send_message(chat_id=chat_id, text=f"❌ Снимок не создан: {e}")
+            return
+        report['seconds'] = time.monotonic() - started
+        
+        print(f"💾 Снимок {report['id']}: изменено {report['changed']} из {report['files']} файлов")
+        if bot and chat_id:
+            await bot.send_message(chat_id=chat_id, text=(
+                f"✅ Снимок {report['id']} сохранен\n\n"
+                f"📁 Файлов: {report['files']}, изменено: {report['changed']}\n"
+                f"📦 Скопировано: {report['bytes'] / 1024:.0f} КБ за {report['seconds']:.1f} сек\n"
+                f"⏸ Пауза бота: {report['pause_ms']:.0f} мс"
+            ))
+
+    def _store(self, snapshot_id, previous, files, changed):
+        """Сжимает файлы снимка и считает sha256 (выполняется в фоновом потоке)"""
+        snapshot_dir = os.path.join(self.backups_dir, snapshot_id)
+        staging = os.path.join(snapshot_dir, 'staging')
+        started = time.monotonic()
+        copied = 0
+        for rel in changed:
+            with open(os.path.join(staging, rel), 'rb') as f:
+                content = f.read()
+            target = os.path.join(snapshot_dir, 'files', self._backup_name(rel))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if rel.endswith('.gz'):
+                with open(target, 'wb') as f:
+                    f.write(content)
+            else:
+                with gzip.open(target, 'wb') as f:
+                    f.write(content)
+            files[rel]['sha256'] = hashlib.sha256(content).hexdigest()
+            copied += len(content)
+            
+            # Не мешаем обработчикам: держим скорость копирования в пределах лимита
+            delay = copied / self.bytes_per_second - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        shutil.rmtree(staging, ignore_errors=True)
+        
+        # Цепочка снимков: каждый ссылается на предыдущий
+        self._write_json(os.path.join(snapshot_dir, 'manifest.json'), {
+            'id': snapshot_id,
+            'parent': previous['id'] if previous else None,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'files': files
+        })
+        self._write_json(self.latest_file, {'id': snapshot_id})
+        return copied
+
+    def restore(self, snapshot_id=None):
+        """Восстанавливает папку статистики из снимка и пересчитывает сводки.
+        Бот при этом должен быть остановлен"""
+        manifest = self.load_manifest(snapshot_id)
+        if not manifest:
+            raise ValueError('Нет ни одного снимка')
+        
+        restore_dir = self.stats_dir + '.restore'
+        shutil.rmtree(restore_dir, ignore_errors=True)
+        for rel, entry in manifest['files'].items():
+            source = os.path.join(self.backups_dir, entry['snapshot'], 'files', self._backup_name(rel))
+            with open(source, 'rb') as f:
+                content = f.read()
+            if not rel.endswith('.gz'):
+                content = gzip.decompress(content)
+            if hashlib.sha256(content).hexdigest() != entry['sha256']:
+                raise ValueError(f'Контрольная сумма не совпала: {rel}')
+            target = os.path.join(restore_dir, rel)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(content)
+        
+        # Текущую папку не удаляем, а откладываем в сторону
+        if os.path.exists(self.stats_dir):
+            os.replace(self.stats_dir, f'{self.stats_dir}.before-restore-{int(time.time())}')
+        os.replace(restore_dir, self.stats_dir)
+        
+        for user_id in self.test_manager.iter_user_ids():
+            self.test_manager.rebuild_summary(user_id)
+        return manifest
+
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP = 25
+
+def sample_stacks(thread_id, seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Снимает стек потока каждые interval секунд.
+    Возвращает (число выборок, собственное время по функциям, время с вызовами)"""
+    own = collections.Counter()
+    total = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            code = frame.f_code
+            own[f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}'] += 1
+            # Рекурсивные вызовы считаем в выборке один раз
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                seen.add(f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}')
+                frame = frame.f_back
+            total.update(seen)
+        time.sleep(interval)
+    return samples, own, total
+
+def estimate_size(obj, seen):
+    """Размер объекта вместе со вложенными контейнерами; объекты из seen не считаются"""
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return f'{size / 1024 / 1024:.1f} МБ'
+    return f'{size / 1024:.1f} КБ'
+
+def session_memory_report(application):
+    """Оценка памяти, которую занимают сессии (context.user_data) бота"""
+    seen = set()
+    # Вопросы каталога и банк общие для всех сессий - считаем их отдельно
+    catalog = estimate_size(application.bot_data['test_manager'].get_all_tests(), seen)
+    seen.add(id(application.bot_data['question_bank']))
+    
+    sizes = []
+    by_key = collections.Counter()
+    active = 0
+    for user_id, user_data in application.user_data.items():
+        size = sys.getsizeof(user_data)
+        seen.add(id(user_data))
+        for key, value in user_data.items():
+            key_size = estimate_size(value, seen)
+            by_key[key] += key_size
+            size += key_size
+        sizes.append((size, user_id))
+        if user_data.get('current_test') and not user_data.get('test_completed'):
+            active += 1
+    
+    lines = [f"Сессий: {len(sizes)}, из них с незавершенным тестом: {active}"]
+    if sizes:
+        total = sum(size for size, _ in sizes)
+        largest, largest_user = max(sizes)
+        lines.append(f"Всего: {format_size(total)}, в среднем {format_size(total / len(sizes))}, "
+                     f"максимум {format_size(largest)} (ID {largest_user})")
+        lines.append("По ключам:")
+        for key, size in by_key.most_common(10):
+            lines.append(f"  {format_size(size):>10}  {key}")
+    lines.append(f"Каталог тестов (общий для всех сессий): {format_size(catalog)}")
+    return lines
+
+class Profiler:
+    """Профилирование по команде /profile.
+    
+    Пока профилировщик не запущен, он ничего не делает: поток выборок и
+    tracemalloc работают только в течение заданного окна.
+    """
+
+    def __init__(self):
+        self.task = None
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, application, chat_id, seconds):
+        self.task = asyncio.create_task(self.run(application, chat_id, seconds))
+
+    async def run(self, application, chat_id, seconds):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            # Снимаем стек потока цикла событий - в нем работают все обработчики
+            samples, own, total = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),))
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        
+        lines = [f"Профиль за {seconds} сек: {samples} выборок "
+                 f"(каждые {PROFILE_SAMPLE_INTERVAL * 1000:.0f} мс), поток цикла событий", ""]
+        for title, counter in (("Собственное время (верх стека):", own), ("Время с вызовами:", total)):
+            lines.append(title)
+            for name, count in counter.most_common(PROFILE_TOP):
+                lines.append(f"  {count / max(samples, 1):6.1%}  {name}")
+            lines.append("")
+        
+        lines.append("Места выделения памяти за это время (tracemalloc):")
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            lines.append(f"  {format_size(stat.size):>10}  {stat.count:7d} блоков  "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        lines.append("")
+        
+        lines.append("Память сессий:")
+        lines.extend(session_memory_report(application))
+        
+        await application.bot.send_document(
+            chat_id=chat_id,
+            document=io.BytesIO('\n'.join(lines).encode('utf-8')),
+            filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt",
+            caption=f"🔬 Профиль за {seconds} сек"
+        )
+
+class DeadlineScheduler:
+    """Общий таймер для всех сроков: куча дедлайнов и одна фоновая задача"""
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, key, deadline, callback, *args):
+        """Ставит callback(*args) на момент deadline; прежний срок с тем же ключом отменяется"""
+        self.cancel(key)
+        entry = [deadline, next(self.counter), key, callback, args, True]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        elif self.heap[0] is entry:
+            self.wakeup.set()
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            entry[-1] = False
+
+    def pending(self):
+        return len(self.entries)
+
+    async def _run(self):
+        while True:
+            # Отмененные сроки просто пропускаются
+            while self.heap and not self.heap[0][-1]:
+                heapq.heappop(self.heap)
+            
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            deadline, _, key, callback, args, _ = heapq.heappop(self.heap)
+            self.entries.pop(key, None)
+            asyncio.create_task(self._fire(callback, args))
+
+    async def _fire(self, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            print(f"❌ Ошибка в таймере: {e}")
+
+class SharedConnectionPool:
+    """Один пул HTTP-соединений с Telegram для всех ботов процесса"""
+
+    def __init__(self):
+        self.client = None
+        self.users = 0
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который берет клиент из общего пула, а не создает свой"""
+
+    def __init__(self, pool, **kwargs):
+        self.pool = pool
+        super().__init__(**kwargs)
+
+    def _build_client(self):
+        if self.pool.client is None or self.pool.client.is_closed:
+            self.pool.client = super()._build_client()
+        return self.pool.client
+
+    async def initialize(self):
+        await super().initialize()
+        self.pool.users += 1
+
+    async def shutdown(self):
+        # Клиент закрывается, когда его отпустил последний бот
+        self.pool.users -= 1
+        if self.pool.users <= 0:
+            await super().shutdown()
+
+class SharedResources:
+    """Ресурсы, общие для всех ботов процесса"""
+
+    def __init__(self, connection_pool_size=256):
+        self.connection_pool = SharedConnectionPool()
+        self.connection_pool_size = connection_pool_size
+        self.deadline_scheduler = DeadlineScheduler()
+        self.stats_store = StatsStore()
+        self.sheet_recognizer = AnswerSheetRecognizer()
+        self.profiler = Profiler()
+
+    def request(self):
+        return SharedHTTPXRequest(self.connection_pool, connection_pool_size=self.connection_pool_size)
+
+    def close(self):
+        self.sheet_recognizer.shutdown()
+
+async def expire_test(application, user_id, chat_id, test_name, attempt_id):
+    """Срок теста истек: сообщает пользователю, если ответы еще не отправлены"""
+    user_data = application.user_data.get(user_id)
+    
+    # Проверяем, не отправлены ли уже ответы
+    if user_data is None or user_data.get('attempt_id') != attempt_id or user_data.get('test_completed'):
+        print(f"⏰ Таймер отменен - тест '{test_name}' уже завершен")
+        return
+    
+    print(f"⏰ Время вышло для теста '{test_name}'")
+    user_data['time_expired'] = True
+    user_data['test_completed'] = True
+    user_data.pop('deadline_key', None)
+    await application.bot.send_message(
+        chat_id=chat_id,
+        text=f"⏰ ВРЕМЯ ВЫШЛО!\n\n"
+             f"Тест '{test_name}' завершен.\n"
+             f"Вы не успели отправить ответы вовремя.\n\n"
+             f"➡️ Используйте /start чтобы начать новый тест."
+    )
+
+def schedule_test_deadline(context, user_id, chat_id, test_name):
+    """Ставит срок сдачи теста в общий планировщик"""
+    # Срок хранится в user_data, чтобы пережить перезапуск
+    context.user_data.update({
+        'deadline': time.time() + TEST_TIME_SECONDS,
+        'chat_id': chat_id,
+        'test_name': test_name
+    })
+    arm_test_deadline(context.application, user_id, context.user_data)
+    print(f"⏰ Таймер запущен для теста '{test_name}'")
+
+def arm_test_deadline(application, user_id, user_data):
+    key = (application.bot_data['tenant'], user_id)
+    user_data['deadline_key'] = key
+    application.bot_data['deadline_scheduler'].schedule(
+        key, user_data['deadline'], expire_test,
+        application, user_id, user_data['chat_id'], user_data['test_name'], user_data['attempt_id']
+    )
+
+def restore_sessions(application):
+    """После перезапуска: вопросы каталога снова общие, сроки сдачи - в планировщике"""
+    test_manager = application.bot_data['test_manager']
+    restored = deadlines = 0
+    for user_id, user_data in application.user_data.items():
+        if not user_data.get('current_test') or user_data.get('test_completed'):
+            continue
+        restored += 1
+        
+        # Из файла сессий вопросы читаются копией - заменяем их тестом из каталога
+        test = test_manager.get_test(user_data['current_test'])
+        questions = test.get('questions', []) if test else []
+        if user_data.get('questions') and len(questions) == len(user_data['questions']):
+            user_data['questions'] = questions
+        
+        # Прошедший за время простоя срок сработает сразу
+        if user_data.get('deadline_key'):
+            arm_test_deadline(application, user_id, user_data)
+            deadlines += 1
+    return restored, deadlines
+
+async def refuse_while_draining(query, context):
+    """Во время остановки бота новые тесты не начинаются"""
+    if not context.bot_data.get('draining'):
+        return False
+    await query.answer("⏳ Бот перезапускается. Начните тест через минуту", show_alert=True)
+    return True
+
+def cancel_test_deadline(context):
+    key = context.user_data.pop('deadline_key', None)
+    if key:
+        context.bot_data['deadline_scheduler'].cancel(key)
+
+def get_test_manager(context):
+    """Общий для всех обработчиков менеджер тестов"""
+    return context.bot_data['test_manager']
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отбрасывает повторно доставленные обновления до любой обработки"""
+    keys = [f'update:{update.update_id}']
+    if update.callback_query:
+        keys.append(f'callback:{update.callback_query.id}')
+    
+    if not context.bot_data['deduplicator'].claim(*keys):
+        print(f"🔁 Повторное обновление {update.update_id} пропущено")
+        raise ApplicationHandlerStop
+
+def finish_attempt(context, user_id, check):
+    """Проверяет попытку один раз: check() проверяет и сохраняет результат.
+    
+    Возвращает None, если эта попытка уже завершалась. Завершение пишется
+    на диск только после сохранения результата, при ошибке попытку можно
+    завершить еще раз.
+    """
+    attempt_id = context.user_data.get('attempt_id')
+    if not attempt_id:
+        return check()
+    
+    deduplicator = context.bot_data['deduplicator']
+    key = f'finish:{user_id}:{attempt_id}'
+    if not deduplicator.claim(key, pending=True):
+        return None
+    try:
+        result = check()
+    except Exception:
+        deduplicator.release(key)
+        raise
+    if 'error' in result:
+        deduplicator.release(key)
+    else:
+        deduplicator.confirm(key)
+    return result
+
+def get_questions(context):
+    """Вопросы текущего теста: из каталога или из банка по индексам"""
+    generated = context.user_data.get('generated')
+    if generated:
+        return context.bot_data['question_bank'].view(generated['indices'])
+    return context.user_data.get('questions') or []
+
+def get_current_test(context):
+    """Текущий тест пользователя: из каталога или сгенерированный"""
+    generated = context.user_data.get('generated')
+    if generated:
+        return context.bot_data['question_bank'].build_test(generated)
+    return get_test_manager(context).get_test(context.user_data.get('current_test'))
+
+def record_dwell(user_data):
+    """Добавляет время, проведенное на текущем вопросе"""
+    shown_question = user_data.get('shown_question')
+    dwell = user_data.get('dwell')
+    if shown_question is None or dwell is None or shown_question >= len(dwell):
+        return
+    now = time.time()
+    dwell[shown_question] = min(0xFFFF, dwell[shown_question] + round(now - user_data['shown_at']))
+    user_data['shown_at'] = now
+
+def build_timing(user_data):
+    """Время теста для записи в результат: общая длительность и упакованное время по вопросам"""
+    started_at = user_data.get('started_at')
+    if started_at is None:
+        return None
+    record_dwell(user_data)
+    timing = {'duration': int(time.time() - started_at)}
+    if user_data.get('dwell'):
+        timing['dwell'] = pack_dwell(user_data['dwell'])
+    return timing
+
+def complete_test(context):
+    """Отменяет таймер и помечает тест (и сессию экзамена) завершенным"""
+    cancel_test_deadline(context)
+    
+    context.user_data['test_completed'] = True
+    exam_session = context.user_data.get('exam_session')
+    if exam_session:
+        exam_session['completed'] = True
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Главное меню"""
@@ -300,7 +2450,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     
     # Добавляем админ-панель для администраторов
-    if is_admin(user_id):
+    if is_admin(user_id, context):
         keyboard.append([InlineKeyboardButton("⚙️ Админ-панель", callback_data='admin_panel')])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -337,7 +2487,7 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_test_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает список тестов"""
     query = update.callback_query
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
     tests = test_manager.get_all_tests()
     
     if not tests:
@@ -358,6 +2508,9 @@ async def show_test_selection(update: Update, context: ContextTypes.DEFAULT_TYPE
             callback_data=f'test_{test_id}'
         )])
     
+    if len(context.bot_data['question_bank']):
+        keyboard.append([InlineKeyboardButton(ADAPTIVE_TEST_NAME, callback_data='adaptive_test')])
+    
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -371,10 +2524,12 @@ async def show_test_selection(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def start_test_with_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Запуск теста с интерактивными кнопками"""
     query = update.callback_query
+    if await refuse_while_draining(query, context):
+        return None
     await query.answer()
     
     test_id = query.data.replace('test_', '')
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
     test = test_manager.get_test(test_id)
     
     if not test:
@@ -387,29 +2542,140 @@ async def start_test_with_buttons(update: Update, context: ContextTypes.DEFAULT_
     # Сохраняем данные теста
     context.user_data.update({
         'current_test': test_id,
+        'attempt_id': uuid.uuid4().hex[:12],
         'test_completed': False,
         'time_expired': False,
         'current_question': 0,
-        'user_answers': [],
-        'questions': test.get('questions', [])
+        'user_answers': [None] * len(test.get('questions', [])),
+        'questions': test.get('questions', []),
+        'started_at': time.time(),
+        'dwell': array('H', [0]) * len(test.get('questions', []))
     })
     
     # Запускаем таймер
-    context.user_data['timer_task'] = asyncio.create_task(
-        timer_task(context, query.message.chat_id, test['name'])
-    )
+    schedule_test_deadline(context, query.from_user.id, query.message.chat_id, test['name'])
+    
+    # Бумажный тест: отправляем задания и ждем ответы текстом или фото бланка
+    if not context.user_data['questions']:
+        await show_paper_test(query, context, test, "⏰ Время на тест: 1 час 5 минут")
+        return WAITING_ANSWERS
     
     # Показываем первый вопрос с кнопками
     await show_question_with_buttons(update, context, 0)
     
     return WAITING_ANSWERS_BUTTONS
 
-async def show_question_with_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, question_index):
-    """Показывает вопрос с кнопками ответов"""
-    questions = context.user_data['questions']
+async def start_adaptive_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запуск персонального теста из банка вопросов"""
+    query = update.callback_query
+    if await refuse_while_draining(query, context):
+        return None
+    await query.answer()
+    
+    user_id = query.from_user.id
+    question_bank = context.bot_data['question_bank']
+    
+    # Уровень ученика - средний результат последних персональных тестов
+    stats = get_test_manager(context).get_user_statistics(user_id) or {}
+    recent = [test['result']['percentage'] for test in stats.get('tests', [])
+              if test['test_id'] == ADAPTIVE_TEST_ID][-5:]
+    level = sum(recent) / len(recent) if recent else None
+    
+    generated = question_bank.generate(user_id, ADAPTIVE_TEST_QUESTIONS, level)
+    
+    context.user_data.clear()
+    context.user_data.update({
+        'current_test': ADAPTIVE_TEST_ID,
+        'attempt_id': uuid.uuid4().hex[:12],
+        'test_completed': False,
+        'time_expired': False,
+        'current_question': 0,
+        'user_answers': [None] * len(generated['indices']),
+        'generated': generated,
+        'started_at': time.time(),
+        'dwell': array('H', [0]) * len(generated['indices'])
+    })
+    
+    # Запускаем таймер
+    schedule_test_deadline(context, user_id, query.message.chat_id, ADAPTIVE_TEST_NAME)
+    
+    await show_question_with_buttons(update, context, 0)
+    
+    return WAITING_ANSWERS_BUTTONS
+
+async def show_paper_test(query, context, test, time_text):
+    """Отправляет задания бумажного теста и объясняет, как сдать ответы"""
+    await query.edit_message_text(
+        f"📝 {test['name']}\n\n"
+        f"{time_text}\n\n"
+        f"Отправьте {test['questions_count']} ответов одним сообщением: A,B,C,D,...\n"
+        f"или фото заполненного бланка ответов 📷"
+    )
+    test_manager = get_test_manager(context)
+    if test.get('pdf_filename'):
+        await test_manager.send_test_pdf(
+            context.bot, query.message.chat_id, test['pdf_filename']
+        )
+    # Распознаются только бланки с угловыми метками - отправляем пустой для печати
+    await test_manager.send_answer_sheet(
+        context.bot, query.message.chat_id, test['questions_count'],
+        caption="🖨 Бланк ответов: распечатайте, закрасьте кружки и пришлите фото всего листа"
+    )
+
+async def start_exam_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало экзамена по приглашению"""
+    query = update.callback_query
+    if await refuse_while_draining(query, context):
+        return None
+    await query.answer()
+    
+    window_id = query.data.replace('exam_', '')
+    user_id = query.from_user.id
+    exam_scheduler = context.bot_data['exam_scheduler']
+    window = exam_scheduler.get_open_window(window_id, user_id)
+    session = exam_scheduler.get_session(window_id, user_id) if window else None
+    
+    if not session:
+        await query.edit_message_text("❌ Экзамен недоступен или уже завершен")
+        return MAIN_MENU
+    if session['completed']:
+        await query.edit_message_text("✅ Вы уже сдали этот экзамен")
+        return MAIN_MENU
+    
+    test = get_test_manager(context).get_test(window['test_id'])
+    
+    # Прерываем текущий тест, если он был
+    cancel_test_deadline(context)
+    context.user_data.clear()
+    
+    # Ответы пишутся прямо в заранее выделенную сессию экзамена
+    session['started'] = True
+    context.user_data.update({
+        'current_test': window['test_id'],
+        'attempt_id': f"exam_{window['id']}",
+        'test_completed': False,
+        'time_expired': False,
+        'current_question': 0,
+        'user_answers': session['user_answers'],
+        'questions': test.get('questions', []),
+        'exam_session': session,
+        'started_at': time.time(),
+        'dwell': array('H', [0]) * len(test.get('questions', []))
+    })
+    
+    if not context.user_data['questions']:
+        end_text = datetime.fromtimestamp(window['end']).strftime('%H:%M')
+        await show_paper_test(query, context, test, f"⏰ Ответы принимаются до {end_text}")
+        return WAITING_ANSWERS
+    
+    await show_question_with_buttons(update, context, 0)
+    
+    return WAITING_ANSWERS_BUTTONS
+
+def build_question_keyboard(questions, question_index):
+    """Создает кнопки с вариантами ответов и навигацией"""
     question = questions[question_index]
     
-    # Создаем кнопки с вариантами ответов
     keyboard = []
     row = []
     for i, option in enumerate(question['options']):
@@ -432,7 +2698,25 @@ async def show_question_with_buttons(update: Update, context: ContextTypes.DEFAU
     if nav_buttons:
         keyboard.append(nav_buttons)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_question_with_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, question_index):
+    """Показывает вопрос с кнопками ответов"""
+    questions = get_questions(context)
+    question = questions[question_index]
+    test_id = context.user_data['current_test']
+    
+    # Клавиатуры вопросов из каталога строятся один раз
+    test_manager = get_test_manager(context)
+    if test_manager.get_test(test_id):
+        reply_markup = test_manager.get_question_keyboard(test_id, question_index)
+    else:
+        reply_markup = build_question_keyboard(questions, question_index)
+    
+    # Время на вопросе копится в памяти и сохраняется только вместе с результатом
+    record_dwell(context.user_data)
+    context.user_data['shown_question'] = question_index
+    context.user_data['shown_at'] = time.time()
     
     question_text = f"❓ Вопрос {question_index + 1}/{len(questions)}\n\n{question['question']}"
     
@@ -451,7 +2735,7 @@ async def handle_button_answer(update: Update, context: ContextTypes.DEFAULT_TYP
     question_index = int(parts[1])
     option_index = int(parts[2])
     
-    questions = context.user_data['questions']
+    questions = get_questions(context)
     question = questions[question_index]
     selected_answer = question['options'][option_index]
     
@@ -488,6 +2772,11 @@ async def finish_button_test(update: Update, context: ContextTypes.DEFAULT_TYPE)
     test_id = context.user_data['current_test']
     user_id = update.effective_user.id
     
+    # Повторное нажатие или повторная доставка: тест уже проверен
+    if context.user_data.get('test_completed'):
+        await update.callback_query.message.reply_text("✅ Ответы на этот тест уже приняты")
+        return MAIN_MENU
+    
     # Проверяем, все ли вопросы отвечены
     if None in user_answers:
         await update.callback_query.message.reply_text(
@@ -495,20 +2784,30 @@ async def finish_button_test(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
     
-    # Отменяем таймер
-    timer_task_obj = context.user_data.get('timer_task')
-    if timer_task_obj and not timer_task_obj.done():
-        timer_task_obj.cancel()
-    
     # Проверяем ответы
-    test_manager = TestManager()
-    result = test_manager.check_answers(test_id, user_answers, user_id)
+    test_manager = get_test_manager(context)
+    test = get_current_test(context)
+    result = finish_attempt(context, user_id, lambda: test_manager.check_answers(
+        test_id, user_answers, user_id, test, build_timing(context.user_data)
+    ))
+    if result is None:
+        await update.callback_query.message.reply_text("✅ Ответы на этот тест уже приняты")
+        return MAIN_MENU
     
-    # Помечаем тест как завершенный
-    context.user_data['test_completed'] = True
+    # Отменяем таймер и помечаем тест как завершенный
+    complete_test(context)
+    
+    text, reply_markup = build_result_message(test_manager, test['name'], result, user_id)
+    
+    context.user_data['last_result'] = result
+    
+    await update.callback_query.message.reply_text(text, reply_markup=reply_markup)
     
-    # Форматируем результаты
-    text = f"📊 РЕЗУЛЬТАТЫ: {test_manager.get_test(test_id)['name']}\n\n"
+    return MAIN_MENU
+
+def build_result_message(test_manager, test_name, result, user_id):
+    """Формирует текст и кнопки с результатами теста"""
+    text = f"📊 РЕЗУЛЬТАТЫ: {test_name}\n\n"
     text += f"✅ Правильных: {result['correct_count']}/{result['total_questions']}\n"
     text += f"📈 Процент: {result['percentage']}%\n\n"
     
@@ -536,11 +2835,7 @@ async def finish_button_test(update: Update, context: ContextTypes.DEFAULT_TYPE)
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    context.user_data['last_result'] = result
-    
-    await update.callback_query.message.reply_text(text, reply_markup=reply_markup)
-    
-    return MAIN_MENU
+    return text, reply_markup
 
 async def process_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текстовых ответов пользователя (для обратной совместимости)"""
@@ -568,7 +2863,7 @@ async def process_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ошибка: тест не выбран")
         return await start(update, context)
     
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
     test = test_manager.get_test(test_id)
     
     if not test:
@@ -578,99 +2873,194 @@ async def process_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Парсим ответы
     answers = [ans.strip().upper() for ans in user_message.split(',')]
     
+    if len(answers) != test['questions_count']:
+        await update.message.reply_text(
+            f"❌ Ожидается {test['questions_count']} ответов, получено {len(answers)}"
+        )
+        return WAITING_ANSWERS
+    
     # Проверяем ответы
-    result = test_manager.check_answers(test_id, answers, user_id)
+    result = finish_attempt(context, user_id, lambda: test_manager.check_answers(
+        test_id, answers, user_id, timing=build_timing(context.user_data)
+    ))
+    if result is None:
+        await update.message.reply_text("✅ Ответы на этот тест уже приняты")
+        return MAIN_MENU
     
     if 'error' in result:
         await update.message.reply_text(f"❌ {result['error']}")
         return WAITING_ANSWERS
     
-    # Отменяем таймер если он еще работает
-    timer_task_obj = context.user_data.get('timer_task')
-    if timer_task_obj and not timer_task_obj.done():
-        timer_task_obj.cancel()
-        print("⏰ Таймер отменен - ответы получены")
+    # Отменяем таймер и помечаем тест как завершенный
+    complete_test(context)
     
-    # Помечаем тест как завершенный
-    context.user_data['test_completed'] = True
+    text, reply_markup = build_result_message(test_manager, test['name'], result, user_id)
     
-    # Форматируем результаты
-    text = f"📊 РЕЗУЛЬТАТЫ: {test['name']}\n\n"
-    text += f"✅ Правильных: {result['correct_count']}/{result['total_questions']}\n"
-    text += f"📈 Процент: {result['percentage']}%\n\n"
+    context.user_data['last_result'] = result
     
-    # Оценка
-    if result['percentage'] >= 90:
-        text += "🎉 Отлично! Превосходный результат!\n"
-    elif result['percentage'] >= 70:
-        text += "👍 Хорошо! Solid knowledge!\n"
-    elif result['percentage'] >= 50:
-        text += "⚠️ Удовлетворительно. Есть над чем поработать.\n"
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    
+    return MAIN_MENU
+
+async def process_answer_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверка ответов по фото бланка"""
+    test_id = context.user_data.get('current_test')
+    user_id = update.effective_user.id
+    questions = get_questions(context)
+    state = WAITING_ANSWERS_BUTTONS if questions else WAITING_ANSWERS
+    
+    if context.user_data.get('time_expired') or context.user_data.get('test_completed'):
+        await update.message.reply_text(
+            "❌ Этот тест уже завершен.\n\n"
+            "➡️ Используйте /start чтобы начать новый тест."
+        )
+        return MAIN_MENU
+    
+    test_manager = get_test_manager(context)
+    test = get_current_test(context) if test_id else None
+    if not test:
+        await update.message.reply_text("❌ Тест не найден")
+        return await start(update, context)
+    
+    recognizer = context.bot_data['sheet_recognizer']
+    if not recognizer.is_available():
+        await update.message.reply_text("❌ Распознавание бланков недоступно. Отправьте ответы текстом.")
+        return state
+    if recognizer.is_busy():
+        await update.message.reply_text("⏳ Сейчас много бланков на проверке, отправьте фото через минуту.")
+        return state
+    
+    # Фото можно прислать и как сжатое изображение, и как файл
+    message = update.message
+    photo_file = await (message.photo[-1] if message.photo else message.document).get_file()
+    image_bytes = bytes(await photo_file.download_as_bytearray())
+    await message.reply_text("📷 Бланк получен, распознаю ответы...")
+    
+    options_count = len(questions[0]['options']) if questions else 4
+    try:
+        letters = await recognizer.recognize(image_bytes, test['questions_count'], options_count)
+    except Exception as e:
+        print(f"❌ Ошибка распознавания бланка: {e}")
+        await message.reply_text("❌ Не удалось прочитать изображение. Попробуйте другое фото.")
+        return state
+    
+    if letters is None:
+        await message.reply_text(
+            "❌ Не найдены угловые метки бланка.\n\n"
+            "Сфотографируйте бланк целиком, сверху, на светлом фоне."
+        )
+        return state
+    
+    missing = [str(i + 1) for i, letter in enumerate(letters) if letter is None]
+    if missing:
+        await message.reply_text(
+            f"❌ Не удалось распознать ответы на вопросы: {', '.join(missing)}\n\n"
+            "Закрасьте по одному кружку в строке и пришлите фото еще раз."
+        )
+        return state
+    
+    # Для тестов с кнопками буква обозначает вариант ответа
+    if questions:
+        answers = [q['options'][OMR_OPTION_LETTERS.index(letter)] for q, letter in zip(questions, letters)]
     else:
-        text += "📚 Нужно повторить материал.\n"
+        answers = letters
     
-    # Проверяем достижения
-    achievements = test_manager.achievement_system.check_achievements(user_id, result, test_manager)
-    if achievements:
-        achievement_msg = test_manager.achievement_system.get_achievement_message(achievements)
-        text += f"\n{achievement_msg}"
+    result = finish_attempt(context, user_id, lambda: test_manager.check_answers(
+        test_id, answers, user_id, test, build_timing(context.user_data)
+    ))
+    if result is None:
+        await message.reply_text("✅ Ответы на этот тест уже приняты")
+        return MAIN_MENU
+    if 'error' in result:
+        await message.reply_text(f"❌ {result['error']}")
+        return state
     
-    # Кнопки для деталей
-    keyboard = [
-        [InlineKeyboardButton("📋 Детали результатов", callback_data='show_details')],
-        [InlineKeyboardButton("📊 В статистику", callback_data='show_stats')],
-        [InlineKeyboardButton("📝 Новый тест", callback_data='select_test')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Отменяем таймер и помечаем тест как завершенный
+    complete_test(context)
     
+    text, reply_markup = build_result_message(test_manager, test['name'], result, user_id)
     context.user_data['last_result'] = result
     
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    await message.reply_text(text, reply_markup=reply_markup)
     
     return MAIN_MENU
 
+def render_cached(context, user_id, screen, render):
+    """Экран из кэша; render() вызывается, только если данные пользователя изменились"""
+    cache = context.bot_data['render_cache']
+    key = (user_id, screen, get_test_manager(context).data_version(user_id))
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = render()
+        cache.put(key, *rendered)
+    return rendered
+
 async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику пользователя"""
     query = update.callback_query
     user_id = query.from_user.id
     
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
+    text, reply_markup = render_cached(
+        context, user_id, 'stats', lambda: render_statistics(test_manager, user_id))
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return MAIN_MENU
+
+def render_statistics(test_manager, user_id):
     stats = test_manager.get_user_statistics(user_id)
     
-    if not stats or 'tests' not in stats or not stats['tests']:
+    if not stats or not stats['summary']['total_tests']:
         keyboard = [
             [InlineKeyboardButton("📝 Пройти тест", callback_data='select_test')],
             [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "📊 Статистика\n\n"
-            "У вас пока нет пройденных тестов.",
-            reply_markup=reply_markup
-        )
-        return MAIN_MENU
+        return "📊 Статистика\n\nУ вас пока нет пройденных тестов.", InlineKeyboardMarkup(keyboard)
     
     # Формируем статистику
-    tests = stats['tests']
-    total_tests = len(tests)
-    avg_percentage = sum(test['result']['percentage'] for test in tests) / total_tests
+    summary = stats['summary']
+    total_tests = summary['total_tests']
+    avg_percentage = summary['percentage_sum'] / total_tests
     
     text = f"📊 Ваша статистика\n\n"
     text += f"📈 Всего тестов: {total_tests}\n"
     text += f"🏆 Средний результат: {avg_percentage:.1f}%\n\n"
     
     text += "📋 Последние тесты:\n"
-    for test in tests[-5:]:
+    for test in stats['tests'][-5:]:
         text += f"• {test['test_name']}: {test['result']['percentage']}%\n"
     
     keyboard = [
         [InlineKeyboardButton("📝 Пройти тест", callback_data='select_test')],
+        [InlineKeyboardButton("📜 Вся история (CSV)", callback_data='export_history')],
         [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет всю историю тестов пользователя файлом CSV"""
+    query = update.callback_query
+    await query.answer()
     
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    history = get_test_manager(context).get_full_history(query.from_user.id)
+    if not history:
+        await query.message.reply_text("У вас пока нет пройденных тестов.")
+        return MAIN_MENU
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(['№', 'Тест', 'Верно', 'Вопросов', 'Процент', 'Время, мин'])
+    for i, test in enumerate(history, 1):
+        result = test['result']
+        duration = result.get('timing', {}).get('duration')
+        writer.writerow([i, test['test_name'], result['correct_count'], result['total_questions'],
+                         result['percentage'], duration // 60 if duration is not None else ''])
+    
+    await query.message.reply_document(
+        document=io.BytesIO(buffer.getvalue().encode('utf-8-sig')),
+        filename='history.csv',
+        caption=f"📜 Вся история: {len(history)} тестов"
+    )
     return MAIN_MENU
 
 async def show_achievements(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -678,23 +3068,28 @@ async def show_achievements(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
     
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
+    text, reply_markup = render_cached(
+        context, user_id, 'achievements', lambda: render_achievements(test_manager, user_id))
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return MAIN_MENU
+
+def render_achievements(test_manager, user_id):
     user_stats = test_manager.get_user_statistics(user_id)
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]]
     
     if not user_stats:
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "🏆 Достижения\n\n"
-            "У вас пока нет достижений. Пройдите первый тест!",
-            reply_markup=reply_markup
-        )
-        return MAIN_MENU
+        return ("🏆 Достижения\n\nУ вас пока нет достижений. Пройдите первый тест!",
+                InlineKeyboardMarkup(keyboard))
     
     # Получаем все возможные достижения
-    all_achievements = test_manager.achievement_system.achievements
-    tests_count = len(user_stats.get('tests', []))
+    achievement_system = test_manager.achievement_system
+    all_achievements = achievement_system.achievements
+    summary = user_stats['summary']
+    tests_count = summary['total_tests']
+    best_percentage = summary['best_percentage']
+    has_speedster = summary['speedster']
     
     text = "🏆 Ваши достижения:\n\n"
     
@@ -706,17 +3101,18 @@ async def show_achievements(update: Update, context: ContextTypes.DEFAULT_TYPE):
             has_achievement = True
         elif achievement_id == 'persistent' and tests_count >= 5:
             has_achievement = True
-        # Для остальных достижений нужна более сложная логика
+        elif achievement_id == 'excellent' and best_percentage >= 90:
+            has_achievement = True
+        elif achievement_id == 'perfectionist' and best_percentage == 100:
+            has_achievement = True
+        elif achievement_id == 'speedster' and has_speedster:
+            has_achievement = True
         
         icon = "✅" if has_achievement else "❌"
         text += f"{icon} {achievement['icon']} {achievement['name']}\n"
         text += f"   {achievement['description']}\n\n"
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='back_to_menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(text, reply_markup=reply_markup)
-    return MAIN_MENU
+    return text, InlineKeyboardMarkup(keyboard)
 
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает справку"""
@@ -752,6 +3148,14 @@ async def show_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ Результаты не найдены")
         return MAIN_MENU
     
+    # last_result обновляется вместе с сохранением результата, то есть с версией данных
+    text, reply_markup = render_cached(
+        context, query.from_user.id, 'details', lambda: render_details(result))
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return MAIN_MENU
+
+def render_details(result):
     text = "📋 Детали результатов:\n\n"
     for detail in result['detailed_results']:
         status = "✅" if detail['is_correct'] else "❌"
@@ -760,16 +3164,13 @@ async def show_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += f"Прав: {detail['correct_answer']}\n"
     
     keyboard = [[InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(text, reply_markup=reply_markup)
-    return MAIN_MENU
+    return text, InlineKeyboardMarkup(keyboard)
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Панель администратора"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
+    if not is_admin(user_id, context):
         if update.callback_query:
             await update.callback_query.answer("❌ Доступ запрещен")
         else:
@@ -779,6 +3180,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("📊 Статистика всех", callback_data='admin_stats')],
         [InlineKeyboardButton("👥 Пользователи", callback_data='admin_users')],
+        [InlineKeyboardButton("⏱ Время по вопросам", callback_data='admin_timing')],
+        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast')],
         [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -807,6 +3210,12 @@ async def handle_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYP
         await show_admin_stats(update, context)
     elif action == 'admin_users':
         await show_admin_users(update, context)
+    elif action == 'admin_timing':
+        await show_admin_timing(update, context)
+    elif action == 'admin_broadcast':
+        return await start_broadcast_input(update, context)
+    elif action == 'admin_panel':
+        return await admin_panel(update, context)
     
     return ADMIN_PANEL
 
@@ -814,7 +3223,7 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику всех пользователей"""
     query = update.callback_query
     
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
     all_stats = test_manager.get_all_users_stats()
     
     if not all_stats:
@@ -822,11 +3231,9 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     total_users = len(all_stats)
-    total_tests = sum(len(user['stats'].get('tests', [])) for user in all_stats)
+    total_tests = sum(user['stats']['summary']['total_tests'] for user in all_stats)
     avg_percentage = sum(
-        test['result']['percentage'] 
-        for user in all_stats 
-        for test in user['stats'].get('tests', [])
+        user['stats']['summary']['percentage_sum'] for user in all_stats
     ) / total_tests if total_tests > 0 else 0
     
     text = f"📊 Общая статистика\n\n"
@@ -837,16 +3244,24 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += "Топ пользователей:\n"
     user_scores = []
     for user in all_stats:
-        user_tests = user['stats'].get('tests', [])
-        if user_tests:
-            avg_score = sum(test['result']['percentage'] for test in user_tests) / len(user_tests)
-            user_scores.append((user['user_id'], avg_score, len(user_tests)))
+        summary = user['stats']['summary']
+        if summary['total_tests']:
+            avg_score = summary['percentage_sum'] / summary['total_tests']
+            user_scores.append((user['user_id'], avg_score, summary['total_tests']))
     
     user_scores.sort(key=lambda x: x[1], reverse=True)
     
     for i, (user_id, score, tests_count) in enumerate(user_scores[:5], 1):
         text += f"{i}. ID: {user_id[:8]}... - {score:.1f}% ({tests_count} тестов)\n"
     
+    text += f"\n{context.bot_data['sheet_recognizer'].get_stats_text()}"
+    text += f"🔁 Повторов отброшено: {context.bot_data['deduplicator'].suppressed}\n"
+    text += context.bot_data['render_cache'].get_stats_text()
+    lifecycle = context.bot_data.get('lifecycle')
+    if lifecycle:
+        text += (f"♻️ Запуск: {lifecycle['startup']:.1f} сек, восстановлено сессий {lifecycle['sessions']}"
+                 + (f", простой {lifecycle['downtime']:.0f} сек" if 'downtime' in lifecycle else "") + "\n")
+    
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -856,14 +3271,13 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает список пользователей"""
     query = update.callback_query
     
-    test_manager = TestManager()
+    test_manager = get_test_manager(context)
     all_stats = test_manager.get_all_users_stats()
     
     text = f"👥 Список пользователей: {len(all_stats)}\n\n"
     
     for i, user in enumerate(all_stats[:10], 1):  # Показываем первых 10
-        user_tests = user['stats'].get('tests', [])
-        tests_count = len(user_tests)
+        tests_count = user['stats']['summary']['total_tests']
         text += f"{i}. ID: {user['user_id']} - {tests_count} тестов\n"
     
     if len(all_stats) > 10:
@@ -874,6 +3288,133 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await query.edit_message_text(text, reply_markup=reply_markup)
 
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
+
+async def show_admin_timing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает распределение времени ответа по вопросам"""
+    query = update.callback_query
+    
+    test_manager = get_test_manager(context)
+    durations = {}
+    dwell_by_test = {}
+    # Берем только недавние результаты из файлов пользователей, архив не распаковываем
+    for user in test_manager.get_all_users_stats():
+        for test in user['stats']['tests']:
+            timing = test['result'].get('timing')
+            if not timing:
+                continue
+            # Время до закрытия экзамена не отражает скорость ответов
+            if test['result'].get('auto_closed'):
+                continue
+            durations.setdefault(test['test_name'], []).append(timing['duration'])
+            # В персональных тестах у каждого свои вопросы - считаем только общее время
+            if timing.get('dwell') and test['test_id'] != ADAPTIVE_TEST_ID:
+                per_question = dwell_by_test.setdefault(test['test_name'], [])
+                for i, seconds in enumerate(unpack_dwell(timing['dwell'])):
+                    if i >= len(per_question):
+                        per_question.append([])
+                    per_question[i].append(seconds)
+    
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if not durations:
+        await query.edit_message_text("⏱ Пока нет данных о времени прохождения", reply_markup=reply_markup)
+        return
+    
+    text = "⏱ Время прохождения (медиана / 90-й перцентиль)\n"
+    for test_name, values in durations.items():
+        values.sort()
+        text += (f"\n📝 {test_name}: {len(values)} попыток, "
+                 f"{percentile(values, 0.5) // 60} / {percentile(values, 0.9) // 60} мин\n")
+        for i, seconds in enumerate(dwell_by_test.get(test_name, []), 1):
+            seconds.sort()
+            text += f"   {i:2d}: {percentile(seconds, 0.5)} / {percentile(seconds, 0.9)} сек\n"
+    
+    await query.edit_message_text(text[:4000], reply_markup=reply_markup)
+
+async def start_broadcast_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запрашивает текст рассылки"""
+    query = update.callback_query
+    broadcast_manager = context.bot_data['broadcast_manager']
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if broadcast_manager.is_running():
+        state = broadcast_manager.get_state()
+        await query.edit_message_text(
+            "📢 Рассылка уже идет\n\n"
+            f"✅ Отправлено: {state['sent']}\n"
+            f"🚫 Заблокировали бота: {state['blocked']}\n"
+            f"❌ Ошибок: {state['failed']}",
+            reply_markup=reply_markup
+        )
+        return ADMIN_PANEL
+    
+    await query.edit_message_text(
+        "📢 Рассылка\n\n"
+        "Отправьте текст сообщения для всех пользователей.",
+        reply_markup=reply_markup
+    )
+    return BROADCAST_TEXT
+
+async def receive_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получает текст рассылки и предлагает приложить PDF"""
+    if not is_admin(update.effective_user.id, context):
+        return MAIN_MENU
+    
+    context.user_data['broadcast_text'] = update.message.text
+    
+    keyboard = []
+    pdf_dir = get_test_manager(context).pdf_dir
+    if os.path.exists(pdf_dir):
+        for filename in sorted(os.listdir(pdf_dir)):
+            if filename.endswith('.pdf'):
+                keyboard.append([InlineKeyboardButton(f"📎 {filename}", callback_data=f'bcpdf_{filename}')])
+    keyboard.append([InlineKeyboardButton("✉️ Без PDF", callback_data='bcpdf_none')])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data='admin_panel')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        "📢 Приложить PDF теста к рассылке?",
+        reply_markup=reply_markup
+    )
+    return BROADCAST_CONFIRM
+
+async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запускает рассылку"""
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id, context):
+        return MAIN_MENU
+    
+    text = context.user_data.pop('broadcast_text', None)
+    pdf_name = query.data.replace('bcpdf_', '')
+    if pdf_name == 'none':
+        pdf_name = None
+    
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    broadcast_manager = context.bot_data['broadcast_manager']
+    if not text:
+        await query.edit_message_text("❌ Текст рассылки не найден", reply_markup=reply_markup)
+        return ADMIN_PANEL
+    if broadcast_manager.is_running():
+        await query.edit_message_text("❌ Рассылка уже идет", reply_markup=reply_markup)
+        return ADMIN_PANEL
+    
+    broadcast_manager.start(context.bot, text, pdf_name)
+    
+    await query.edit_message_text(
+        "📢 Рассылка запущена!\n\n"
+        "Прогресс можно посмотреть в разделе «Рассылка».",
+        reply_markup=reply_markup
+    )
+    return ADMIN_PANEL
+
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Возврат в главное меню"""
     query = update.callback_query
@@ -894,7 +3435,7 @@ async def start_from_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     
     # Добавляем админ-панель для администраторов
-    if is_admin(user_id):
+    if is_admin(user_id, context):
         keyboard.append([InlineKeyboardButton("⚙️ Админ-панель", callback_data='admin_panel')])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -910,56 +3451,455 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда помощи"""
     await update.message.reply_text("Используйте /start для открытия главного меню")
 
+async def exam_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Планирование экзамена: /exam test_id начало конец [id,id,...]"""
+    if not is_admin(update.effective_user.id, context):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    args = context.args
+    exam_scheduler = context.bot_data['exam_scheduler']
+    test_manager = get_test_manager(context)
+    
+    if len(args) == 2 and args[0] == 'cancel':
+        if exam_scheduler.cancel(args[1]):
+            await update.message.reply_text(f"🗑 Экзамен {args[1]} отменен")
+        else:
+            await update.message.reply_text("❌ Экзамен не найден")
+        return
+    
+    if len(args) < 3:
+        text = ("📅 Экзамены\n\n"
+                "Запланировать: /exam test_id 2025-05-20T10:00 2025-05-20T11:05 [id1,id2,...]\n"
+                "Без списка ID экзамен открывается для всех пользователей.\n"
+                "Отменить: /exam cancel id\n\n")
+        for window in exam_scheduler.windows.values():
+            start_text = datetime.fromtimestamp(window['start']).strftime('%d.%m %H:%M')
+            end_text = datetime.fromtimestamp(window['end']).strftime('%H:%M')
+            text += (f"• {window['id']}: {window['test_id']} {start_text}-{end_text}, "
+                     f"{len(window['users'])} учеников ({window['status']})\n")
+        await update.message.reply_text(text)
+        return
+    
+    test_id = args[0]
+    if not test_manager.get_test(test_id):
+        await update.message.reply_text("❌ Тест не найден")
+        return
+    
+    try:
+        start_ts = datetime.strptime(args[1], EXAM_TIME_FORMAT).timestamp()
+        end_ts = datetime.strptime(args[2], EXAM_TIME_FORMAT).timestamp()
+        if len(args) > 3:
+            user_ids = [int(user_id) for user_id in args[3].split(',') if user_id]
+        else:
+            user_ids = list(test_manager.iter_user_ids())
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Пример: /exam test1 2025-05-20T10:00 2025-05-20T11:05")
+        return
+    
+    if end_ts <= start_ts or end_ts <= time.time():
+        await update.message.reply_text("❌ Окончание экзамена должно быть позже начала и текущего времени")
+        return
+    if not user_ids:
+        await update.message.reply_text("❌ Нет учеников для экзамена")
+        return
+    
+    window = exam_scheduler.schedule(
+        context.application, test_id, start_ts, end_ts, user_ids, update.effective_chat.id
+    )
+    await update.message.reply_text(
+        f"📅 Экзамен {window['id']} запланирован\n\n"
+        f"📝 {test_manager.get_test(test_id)['name']}\n"
+        f"🕐 {args[1]} - {args[2]}\n"
+        f"👥 Учеников: {len(window['users'])}"
+    )
+
+async def build_search_index(application):
+    """Строит поисковый индекс при запуске в отдельном потоке, не задерживая обработчики"""
+    started = time.perf_counter()
+    test_manager = application.bot_data['test_manager']
+    tests = dict(test_manager.get_all_tests())
+    question_bank = application.bot_data['question_bank']
+    
+    def build():
+        index = QuestionSearchIndex()
+        for test_id, test in tests.items():
+            index.index_test(test_id, test)
+        index.index_bank(question_bank)
+        return index
+    
+    try:
+        index = await asyncio.to_thread(build)
+    except Exception as e:
+        print(f"❌ Ошибка построения поискового индекса: {e}")
+        return
+    
+    # Тесты, перезагруженные во время построения
+    for test_id in application.bot_data.pop('search_pending', ()):
+        index.index_test(test_id, test_manager.get_test(test_id))
+    application.bot_data['search_index'] = index
+    print(f"🔎 Индекс построен за {time.perf_counter() - started:.1f} сек "
+          f"({index.docs_count} вопросов)")
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск вопросов по тексту: /find запрос"""
+    if not is_admin(update.effective_user.id, context):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    query_text = ' '.join(context.args)
+    if not query_text:
+        await update.message.reply_text("🔎 Использование: /find площадь квадрата")
+        return
+    
+    index = context.bot_data.get('search_index')
+    if index is None:
+        await update.message.reply_text("⏳ Поисковый индекс еще строится, попробуйте через минуту")
+        return
+    started = time.perf_counter()
+    results = index.search(query_text)
+    elapsed = time.perf_counter() - started
+    
+    if not results:
+        await update.message.reply_text("🔎 Ничего не найдено")
+        return
+    
+    test_manager = get_test_manager(context)
+    question_bank = context.bot_data['question_bank']
+    text = f"🔎 Найдено за {elapsed * 1000:.1f} мс:\n\n"
+    for score, ((kind, test_id), position) in results:
+        if kind == 'test':
+            test = test_manager.get_test(test_id)
+            question = test['questions'][position]
+            label = f"{test['name']}, вопрос {position + 1}"
+        else:
+            question = question_bank.get_question(position)
+            topic = question_bank.topic_names[question_bank.topics[position]]
+            label = f"Банк #{position}, {topic}"
+        text += f"• {label}\n  {question['question']}\n  Ответ: {question['correct_answer']}\n\n"
+    
+    # Ограничение Telegram на длину сообщения
+    await update.message.reply_text(text[:4000].rstrip())
+
+async def reload_tests_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитывает измененные файлы тестов и обновляет поисковый индекс"""
+    if not is_admin(update.effective_user.id, context):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    test_manager = get_test_manager(context)
+    changed, removed = test_manager.reload_tests()
+    
+    # Индекс обновляется только для измененных тестов
+    index = context.bot_data.get('search_index')
+    if index is not None:
+        for test_id in changed + removed:
+            index.index_test(test_id, test_manager.get_test(test_id))
+    else:
+        # Индекс еще строится - эти тесты переиндексируются по его готовности
+        context.bot_data.setdefault('search_pending', set()).update(changed + removed)
+    
+    await update.message.reply_text(
+        "🔄 Тесты перезагружены\n\n"
+        f"✏️ Изменено: {', '.join(changed) or 'нет'}\n"
+        f"🗑 Удалено: {', '.join(removed) or 'нет'}"
+    )
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создает инкрементальный снимок статистики, не останавливая бота"""
+    if not is_admin(update.effective_user.id, context):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    backup_manager = context.bot_data['backup_manager']
+    if backup_manager.is_running():
+        await update.message.reply_text("⏳ Предыдущий снимок еще сохраняется")
+        return
+    
+    report = backup_manager.start(context.bot, update.effective_chat.id)
+    await update.message.reply_text(
+        f"💾 Снимок {report['id']} зафиксирован\n\n"
+        f"📁 Изменено файлов: {report['changed']} из {report['files']}\n"
+        "Сжатие идет в фоне, по окончании придет сообщение."
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [секунды] - профиль CPU и памяти, результат приходит файлом"""
+    if not is_admin(update.effective_user.id, context):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    profiler = context.bot_data['profiler']
+    if profiler.is_running():
+        await update.message.reply_text("⏳ Профилирование уже идет")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунды]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    profiler.start(context.application, update.effective_chat.id, seconds)
+    await update.message.reply_text(f"🔬 Профилирование {seconds} сек...")
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда админ-панели"""
     return await admin_panel(update, context)
 
-def main():
-    """Запуск бота"""
-    print("🚀 Запуск бота на Render...")
+# Остановка: столько секунд бот дорабатывает начатое, не принимая новые тесты
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 3))
+PERSISTENCE_UPDATE_INTERVAL = 30
+
+async def post_init(application: Application):
+    """Действия после инициализации бота"""
+    # Сессии и их сроки уже загружены из файла сессий
+    restored, deadlines = restore_sessions(application)
+    # Продолжаем рассылку, прерванную перезапуском
+    application.bot_data['broadcast_manager'].resume(application.bot)
+    # Восстанавливаем расписание экзаменов
+    application.bot_data['exam_scheduler'].arm_all(application)
+    # Поисковый индекс строится в фоне, пока бот уже отвечает
+    application.bot_data['search_task'] = asyncio.create_task(build_search_index(application))
+    
+    # Время готовности: от запуска процесса и от сигнала остановки прежнего
+    now = time.time()
+    lifecycle = {'startup': now - PROCESS_STARTED_AT, 'sessions': restored, 'deadlines': deadlines}
+    lifecycle_file = application.bot_data['lifecycle_file']
+    if os.path.exists(lifecycle_file):
+        try:
+            with open(lifecycle_file, 'r', encoding='utf-8') as f:
+                lifecycle['downtime'] = now - json.load(f)['stop_requested_at']
+        except (OSError, ValueError, KeyError):
+            pass
+    application.bot_data['lifecycle'] = lifecycle
+    print(f"♻️ Готов за {lifecycle['startup']:.1f} сек: восстановлено сессий {restored}, сроков {deadlines}"
+          + (f", простой {lifecycle['downtime']:.1f} сек" if 'downtime' in lifecycle else ""))
+
+async def post_shutdown(application: Application):
+    """Сохранение состояния при остановке бота"""
+    # Сессии сохраняет PicklePersistence при остановке приложения
+    application.bot_data['deduplicator'].save()
+    with open(application.bot_data['lifecycle_file'], 'w', encoding='utf-8') as f:
+        json.dump({
+            'stop_requested_at': application.bot_data.get('stop_requested_at', time.time()),
+            'stopped_at': time.time()
+        }, f)
+
+def request_shutdown(applications, stop):
+    """SIGTERM/SIGINT: новые тесты не начинаются, через SHUTDOWN_DRAIN_SECONDS бот
+    останавливается. Обновления, не полученные до остановки, придут после перезапуска"""
+    if applications[0].bot_data.get('draining'):
+        # Повторный сигнал - останавливаемся сразу
+        stop()
+        return
+    now = time.time()
+    for application in applications:
+        application.bot_data['draining'] = True
+        application.bot_data['stop_requested_at'] = now
+    print(f"🛑 Остановка: новые тесты не принимаются, завершение через {SHUTDOWN_DRAIN_SECONDS:.0f} сек")
+    asyncio.get_running_loop().call_later(SHUTDOWN_DRAIN_SECONDS, stop)
+
+def build_application(token, shared, tenant='default', data_dir='data', admin_ids=ADMIN_IDS):
+    """Создает бота (школу) со своим каталогом, статистикой и администраторами"""
+    # Сессии (user_data и состояния диалогов) переживают перезапуск
+    state_dir = os.path.join(data_dir, 'state')
+    os.makedirs(state_dir, exist_ok=True)
+    persistence = PicklePersistence(
+        os.path.join(state_dir, 'sessions.pickle'),
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        update_interval=PERSISTENCE_UPDATE_INTERVAL
+    )
+    application = (
+        Application.builder().token(token)
+        .request(shared.request()).get_updates_request(shared.request())
+        .persistence(persistence)
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
     
-    # Создаем application
-    application = Application.builder().token(BOT_TOKEN).build()
+    test_manager = TestManager(data_dir, shared.stats_store)
+    application.bot_data.update({
+        'tenant': tenant,
+        'lifecycle_file': os.path.join(state_dir, 'lifecycle.json'),
+        'admin_ids': list(admin_ids),
+        'test_manager': test_manager,
+        'broadcast_manager': BroadcastManager(test_manager, data_dir),
+        'exam_scheduler': ExamScheduler(test_manager, data_dir),
+        'question_bank': QuestionBank(os.path.join(data_dir, 'bank')),
+        'deduplicator': UpdateDeduplicator(data_dir),
+        'render_cache': RenderCache(),
+        'backup_manager': BackupManager(test_manager, data_dir),
+        'deadline_scheduler': shared.deadline_scheduler,
+        'sheet_recognizer': shared.sheet_recognizer,
+        'profiler': shared.profiler
+    })
     
     # Настройка обработчиков
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler('start', start), 
-            CommandHandler('admin', admin_command)
+            CommandHandler('admin', admin_command),
+            CallbackQueryHandler(start_exam_session, pattern='^exam_')
         ],
         states={
             MAIN_MENU: [
                 CallbackQueryHandler(main_menu_handler, pattern='^(select_test|show_stats|show_achievements|help|admin_panel)$'),
                 CallbackQueryHandler(back_to_menu, pattern='^back_to_menu$'),
-                CallbackQueryHandler(show_details, pattern='^show_details$')
+                CallbackQueryHandler(show_details, pattern='^show_details$'),
+                CallbackQueryHandler(export_history, pattern='^export_history$')
             ],
             SELECTING_TEST: [
                 CallbackQueryHandler(start_test_with_buttons, pattern='^test_'),
+                CallbackQueryHandler(start_adaptive_test, pattern='^adaptive_test$'),
                 CallbackQueryHandler(back_to_menu, pattern='^back_to_menu$')
             ],
             WAITING_ANSWERS_BUTTONS: [
                 CallbackQueryHandler(handle_button_answer, pattern='^answer_'),
-                CallbackQueryHandler(handle_navigation, pattern='^(prev_|next_|finish_test)')
+                CallbackQueryHandler(handle_navigation, pattern='^(prev_|next_|finish_test)'),
+                MessageHandler(filters.PHOTO | filters.Document.IMAGE, process_answer_sheet)
             ],
             WAITING_ANSWERS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, process_answers)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_answers),
+                MessageHandler(filters.PHOTO | filters.Document.IMAGE, process_answer_sheet)
             ],
             ADMIN_PANEL: [
                 CallbackQueryHandler(handle_admin_actions, pattern='^admin_'),
                 CallbackQueryHandler(back_to_menu, pattern='^back_to_menu$')
+            ],
+            BROADCAST_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_broadcast_text),
+                CallbackQueryHandler(handle_admin_actions, pattern='^admin_panel$')
+            ],
+            BROADCAST_CONFIRM: [
+                CallbackQueryHandler(confirm_broadcast, pattern='^bcpdf_'),
+                CallbackQueryHandler(handle_admin_actions, pattern='^admin_panel$')
             ]
         },
-        fallbacks=[CommandHandler('cancel', back_to_menu)]
+        fallbacks=[
+            CommandHandler('cancel', back_to_menu),
+            CallbackQueryHandler(start_exam_session, pattern='^exam_')
+        ],
+        name='main',
+        persistent=True
     )
     
+    # Повторы отсекаются раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('help', help_command))
+    application.add_handler(CommandHandler('exam', exam_command))
+    application.add_handler(CommandHandler('find', find_command))
+    application.add_handler(CommandHandler('reload_tests', reload_tests_command))
+    application.add_handler(CommandHandler('backup', backup_command))
+    application.add_handler(CommandHandler('profile', profile_command))
+    
+    return application
+
+def load_tenants(path):
+    """Читает список школ: [{"name", "token" или "token_env", "admin_ids", "data_dir"}]"""
+    with open(path, 'r', encoding='utf-8') as f:
+        tenants = json.load(f)
+    for tenant in tenants:
+        if 'token' not in tenant:
+            tenant['token'] = os.environ[tenant['token_env']]
+        # Администраторы у каждой школы свои: общий список не подставляем
+        if not tenant.get('admin_ids'):
+            raise ValueError(f"Школа {tenant['name']}: не указан список admin_ids")
+        tenant.setdefault('data_dir', os.path.join('data', tenant['name']))
+    return tenants
+
+async def run_tenants(tenants):
+    """Запускает несколько ботов в одном процессе и одном цикле событий"""
+    shared = SharedResources(connection_pool_size=16 + 2 * len(tenants))
+    applications = []
+    
+    # Замеряем память, которую добавляет каждая школа
+    # (в первую входят и общие ресурсы: HTTP-клиент, планировщик)
+    tracemalloc.start()
+    try:
+        for tenant in tenants:
+            before = tracemalloc.get_traced_memory()[0]
+            application = build_application(
+                tenant['token'], shared, tenant['name'], tenant['data_dir'], tenant['admin_ids']
+            )
+            await application.initialize()
+            await post_init(application)
+            used = tracemalloc.get_traced_memory()[0] - before
+            print(f"🏫 {tenant['name']}: +{used / 1024:.0f} КБ памяти")
+            applications.append(application)
+    finally:
+        tracemalloc.stop()
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_shutdown, applications, stop_event.set)
+    
+    try:
+        # Обновления, пришедшие во время перезапуска, обрабатываются (повторы отсекает дедупликатор)
+        for application in applications:
+            await application.updater.start_polling(drop_pending_updates=False)
+            await application.start()
+        
+        print(f"✅ Запущено ботов: {len(applications)}")
+        print("📱 Ожидание сообщений...")
+        await stop_event.wait()
+    finally:
+        for application in applications:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await post_shutdown(application)
+            await application.shutdown()
+        shared.close()
+
+def restore_backup(args):
+    """python bot.py --restore [ID снимка | latest] [папка данных] - бот должен быть остановлен"""
+    snapshot_id = args[0] if args and args[0] != 'latest' else None
+    data_dir = args[1] if len(args) > 1 else 'data'
+    backup_manager = BackupManager(TestManager(data_dir), data_dir)
+    manifest = backup_manager.restore(snapshot_id)
+    print(f"✅ Статистика восстановлена из снимка {manifest['id']} ({len(manifest['files'])} файлов)")
+
+def main():
+    """Запуск бота"""
+    # Несколько школ в одном процессе
+    tenants_file = os.environ.get('TENANTS_FILE')
+    if tenants_file:
+        print("🚀 Запуск ботов для нескольких школ...")
+        asyncio.run(run_tenants(load_tenants(tenants_file)))
+        return
+    
+    print("🚀 Запуск бота на Render...")
+    
+    shared = SharedResources()
+    application = build_application(BOT_TOKEN, shared)
     
     print("✅ Бот запущен и готов к работе!")
     print("📱 Ожидание сообщений...")
     
+    # Свой обработчик сигналов: сначала дорабатываем начатое, потом останавливаемся
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_shutdown, [application], application.stop_running)
+    
     # Запуск бота с обработкой ошибок
-    application.run_polling(drop_pending_updates=True)
+    try:
+        # Обновления, пришедшие во время перезапуска, обрабатываются (повторы отсекает дедупликатор)
+        application.run_polling(drop_pending_updates=False, stop_signals=None)
+    finally:
+        shared.close()
 
 if __name__ == '__main__':
-    main()
+    if '--bench-omr' in sys.argv:
+        benchmark_omr()
+    elif '--bench-bank' in sys.argv:
+        benchmark_question_bank()
+    elif '--bench-search' in sys.argv:
+        benchmark_search()
+    elif '--restore' in sys.argv:
+        restore_backup(sys.argv[sys.argv.index('--restore') + 1:])
+    else:
+        main()